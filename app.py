@@ -2,7 +2,9 @@
 # Onde colar: salve como "app.py" na raiz do projeto.
 
 import os
+import functools
 import json
+import time
 import bcrypt
 import datetime as dt
 from typing import List, Dict, Optional, Tuple, Set
@@ -11,16 +13,19 @@ import pandas as pd
 import streamlit as st
 
 from db import (
-    make_engine, make_sessionmaker, init_db,
+    make_engine, make_sessionmaker, init_db, count_queries,
     User, Role, Config,
     Ingredient, IngredientPrice, Supplier, StockLot, StockMove, LossEvent,
     Recipe, RecipeItem, Product, Client, Order, OrderItem,
     ManualPurchase, ManualPurchaseItem,
     get_or_create_default_config, get_user_permissions, ALL_PERMISSIONS,
-    estimate_product_unit_cost, consume_fifo_for_order, ingredient_shortages, DEFAULT_KANBAN_STAGES,
-    create_login_token, get_user_by_token, delete_token,
+    estimate_unit_costs_bulk, available_quantities, consume_fifo_for_order, ingredient_shortages, DEFAULT_KANBAN_STAGES,
+    create_login_token, get_user_by_token, delete_token, stock_version, user_role_table, sync_admin_flag,
+    recompute_order_total, order_total_trigger_active,
 )
-from sqlalchemy.orm import joinedload
+from sqlalchemy import select, insert, update, func, case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload, raiseload, aliased, undefer
 
 # -----------------------
 # Cache de recursos: engine e sessionmaker
@@ -34,27 +39,77 @@ def get_engine_and_sessionmaker():
 
 engine, SessionLocal = get_engine_and_sessionmaker()
 
-# Debug rápido da conexão com o banco
-try:
+# Debug rápido da conexão com o banco (uma vez por processo; falhas não ficam em cache)
+@st.cache_resource(show_spinner=False)
+def _db_probe() -> bool:
     from sqlalchemy import text as _dbg_text
     with engine.connect() as conn:
         conn.execute(_dbg_text("SELECT 1"))
+    return True
+
+try:
+    _db_probe()
     st.sidebar.success("DB OK (conectado)")
 except Exception as e:
     st.sidebar.error(f"DB erro de conexão: {e}")
+
 # -----------------------
 # Auto-login via token na URL
 # -----------------------
+# Versão global de RBAC (compartilhada entre sessões): mudou papel/permissão -> outras
+# sessões recalculam as suas permissões uma vez, no próximo rerun.
+@st.cache_resource(show_spinner=False)
+def _perms_version() -> Dict[str, int]:
+    return {"v": 0}
+
+def store_perms(perms: Set[str]):
+    # calculado uma vez por versão de RBAC; can() vira só um teste de pertinência em frozenset.
+    # guarda junto o flag de admin para can() não comparar conjuntos a cada botão
+    perms = frozenset(perms)
+    st.session_state["perms"] = perms
+    st.session_state["is_admin"] = (perms == ALL_PERMISSIONS)
+    st.session_state["perms_version"] = _perms_version()["v"]
+    st.session_state.pop("allowed_pages", None)  # recalculada sob demanda em allowed_pages()
+
+def refresh_own_perms(s):
+    user = st.session_state.get("user")
+    if user:
+        # após append/remove + commit as roles estão expiradas: get_user_permissions
+        # as lê direto da tabela de associação numa consulta só
+        u = s.get(User, user["id"])
+        store_perms(get_user_permissions(s, u) if u else set())
+
+def on_rbac_changed(s):
+    # após mudar papéis/permissões: invalida todas as sessões e tokens resolvidos
+    _perms_version()["v"] += 1
+    _resolve_token.clear()
+    refresh_own_perms(s)
+
+def ensure_fresh_perms():
+    if st.session_state.get("perms_version") != _perms_version()["v"]:
+        with SessionLocal() as s:
+            refresh_own_perms(s)
+
+@st.cache_data(show_spinner=False, ttl=30)
+def _resolve_token(tok: str) -> Optional[Tuple[int, str, Set[str]]]:
+    # só primitivos no retorno: o User não sai da sessão
+    with SessionLocal() as s:
+        u = get_user_by_token(s, tok)
+        if u and u.is_active:
+            return u.id, u.username, get_user_permissions(s, u)
+    return None
+
 def try_auto_login_from_token():
-    params = st.query_params
-    tok = params.get("token", [None])
+    if "user" in st.session_state:
+        return
+    tok = st.query_params.get("token", [None])
     tok = tok[0] if isinstance(tok, list) else tok
-    if tok and "user" not in st.session_state:
-        with SessionLocal() as s:
-            u = get_user_by_token(s, tok)
-            if u and u.is_active:
-                st.session_state["user"] = {"id": u.id, "username": u.username}
-                st.session_state["perms"] = get_user_permissions(s, u)
+    if tok:
+        resolved = _resolve_token(tok)
+        if resolved:
+            uid, username, perms = resolved
+            st.session_state["user"] = {"id": uid, "username": username}
+            store_perms(perms)
 
 try_auto_login_from_token()
 
@@ -64,9 +119,12 @@ try_auto_login_from_token()
 def copy_hint(msg: str = "Dica: use Ctrl+C/Cmd+C para copiar."):
     st.caption(msg)
 
+# troca "," <-> "." numa única passada (1,234.50 -> 1.234,50)
+_MONEY_TRANS = str.maketrans(",.", ".,")
+
 def fmt_money(v: float) -> str:
     try:
-        return f"R$ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        return f"R$ {v:,.2f}".translate(_MONEY_TRANS)
     except Exception:
         return f"R$ {v}"
 
@@ -77,8 +135,7 @@ def toast_err(msg: str):
     st.error(msg)
 
 def can(code: str) -> bool:
-    perms: Set[str] = st.session_state.get("perms") or set()
-    return (code in perms) or (perms == ALL_PERMISSIONS)
+    return bool(st.session_state.get("is_admin")) or code in (st.session_state.get("perms") or ())
 
 PAGE_PERMISSION = {
     "Dashboard": "page.dashboard",
@@ -97,33 +154,106 @@ PAGE_PERMISSION = {
     "Usuários & Acessos": "page.users",
 }
 
+# Permissões agrupadas pelo prefixo (editor de papéis); ALL_PERMISSIONS não muda em runtime.
+PERMISSION_GROUPS: Dict[str, List[str]] = {}
+for _perm in sorted(ALL_PERMISSIONS):
+    PERMISSION_GROUPS.setdefault(_perm.split(".")[0], []).append(_perm)
+
 # -----------------------
 # Cache de listas estáveis
 # -----------------------
-@st.cache_data(show_spinner=False, ttl=60)
-def cached_products():
+# Regra: cache_data só devolve primitivos/tuplas (é serializado a cada leitura);
+# nunca objetos ORM. Objetos como Config ficam em cache_resource + versão.
+# Listas/config somente-leitura compartilhadas entre sessões; invalidadas por versão
+# (bump_cache_version) em vez de TTL, evitando o pickle/hash do cache_data.
+@st.cache_resource(show_spinner=False)
+def _cache_versions() -> Dict[str, int]:
+    return {"products": 0, "ingredients": 0, "clients": 0, "config": 0, "roles": 0, "users": 0}
+
+def bump_cache_version(name: str):
+    _cache_versions()[name] += 1
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_products(version: int):
     with SessionLocal() as s:
-        q = s.query(Product).filter(Product.is_active == True).order_by(Product.name.asc()).all()
-        return [(p.id, p.name) for p in q]
+        rows = s.execute(
+            select(Product.id, Product.name).where(Product.is_active == True).order_by(Product.name.asc())
+        ).all()
+        return tuple(tuple(r) for r in rows)
 
-@st.cache_data(show_spinner=False, ttl=60)
-def cached_ingredients():
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_ingredients(version: int):
     with SessionLocal() as s:
-        q = s.query(Ingredient).filter(Ingredient.is_active == True).order_by(Ingredient.name.asc()).all()
-        return [(i.id, i.name, i.unit) for i in q]
+        rows = s.execute(
+            select(Ingredient.id, Ingredient.name, Ingredient.unit).where(Ingredient.is_active == True).order_by(Ingredient.name.asc())
+        ).all()
+        return tuple(tuple(r) for r in rows)
 
-@st.cache_data(show_spinner=False, ttl=60)
-def cached_clients():
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_clients(version: int):
+    with SessionLocal() as s:
+        rows = s.execute(
+            select(Client.id, Client.name).where(Client.is_active == True).order_by(Client.name.asc())
+        ).all()
+        return tuple(tuple(r) for r in rows)
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_roles(version: int):
     with SessionLocal() as s:
-        q = s.query(Client).filter(Client.is_active == True).order_by(Client.name.asc()).all()
-        return [(c.id, c.name) for c in q]
+        rows = s.execute(select(Role.id, Role.name).order_by(Role.name.asc())).all()
+        return tuple(tuple(r) for r in rows)
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _load_users(version: int):
+    with SessionLocal() as s:
+        rows = s.execute(select(User.id, User.username).order_by(User.username.asc())).all()
+        return tuple(tuple(r) for r in rows)
+
+def cached_products():
+    return _load_products(_cache_versions()["products"])
+
+def cached_ingredients():
+    return _load_ingredients(_cache_versions()["ingredients"])
+
+def cached_clients():
+    return _load_clients(_cache_versions()["clients"])
+
+def cached_roles():
+    return _load_roles(_cache_versions()["roles"])
+
+def cached_users():
+    return _load_users(_cache_versions()["users"])
 
 # -----------------------
 # Autenticação
 # -----------------------
+LOGIN_MAX_ATTEMPTS = 5
+LOGIN_WINDOW_SECONDS = 60
+
+def hash_password(pwd: str) -> str:
+    # BCRYPT_ROUNDS (env) sobrepõe a Config, p.ex. custo menor em desenvolvimento
+    rounds = int(os.getenv("BCRYPT_ROUNDS") or load_config().bcrypt_rounds or 11)
+    return bcrypt.hashpw(pwd.encode("utf-8"), bcrypt.gensalt(rounds=rounds)).decode("utf-8")
+
+def _recent_login_failures(username: str) -> List[float]:
+    attempts: Dict[str, List[float]] = st.session_state.setdefault("login_attempts", {})
+    now = time.time()
+    recent = [t for t in attempts.get(username, []) if now - t < LOGIN_WINDOW_SECONDS]
+    attempts[username] = recent
+    return recent
+
+# Só o "sim" fica em cache: depois que existe um usuário a resposta nunca volta a ser "não";
+# enquanto não existe, continua consultando (um seed externo também é percebido).
+@st.cache_resource(show_spinner=False)
+def _users_exist_flag() -> Dict[str, bool]:
+    return {"v": False}
+
 def users_exist() -> bool:
-    with SessionLocal() as s:
-        return s.query(User).count() > 0
+    flag = _users_exist_flag()
+    if not flag["v"]:
+        with SessionLocal() as s:
+            flag["v"] = s.query(User.id).first() is not None
+    return flag["v"]
 
 def create_first_admin():
     st.header("Configuração inicial — criar administrador")
@@ -138,7 +268,7 @@ def create_first_admin():
             if not username or not pwd or pwd != pwd2:
                 toast_err("Dados inválidos ou senhas não conferem.")
                 return
-            phash = bcrypt.hashpw(pwd.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+            phash = hash_password(pwd)
             with SessionLocal() as s:
                 if s.query(User).filter(User.username == username).first():
                     toast_err("Usuário já existe.")
@@ -150,7 +280,9 @@ def create_first_admin():
                     toast_err("Papel 'admin' não encontrado. Reinicie o app.")
                     return
                 u.roles.append(admin_role)
+                u.is_admin = True
                 s.commit()
+                bump_cache_version("users")
                 toast_ok("Administrador criado. Faça login na barra lateral.")
 
 def login_sidebar():
@@ -165,8 +297,9 @@ def login_sidebar():
             if tok:
                 with SessionLocal() as s:
                     delete_token(s, tok)
+                _resolve_token.clear()
             st.query_params.clear()
-            for k in ["user", "perms"]:
+            for k in ["user", "perms", "is_admin", "allowed_pages"]:
                 st.session_state.pop(k, None)
             st.rerun()
         return
@@ -176,13 +309,22 @@ def login_sidebar():
         pwd = st.text_input("Senha", type="password")
         ok = st.form_submit_button("Entrar")
         if ok:
+            # limita tentativas por usuário antes de gastar CPU com bcrypt
+            failures = _recent_login_failures(username)
+            if len(failures) >= LOGIN_MAX_ATTEMPTS:
+                time.sleep(1)
+                toast_err("Muitas tentativas. Aguarde um minuto e tente novamente.")
+                return
             with SessionLocal() as s:
-                u = s.query(User).filter(User.username == username, User.is_active == True).first()
+                u = s.query(User).options(selectinload(User.roles), undefer(User.password_hash))\
+                    .filter(User.username == username, User.is_active == True).first()
                 if not u or not bcrypt.checkpw(pwd.encode("utf-8"), (u.password_hash or "").encode("utf-8")):
+                    failures.append(time.time())
                     toast_err("Credenciais inválidas.")
                     return
+                st.session_state["login_attempts"].pop(username, None)
                 st.session_state["user"] = {"id": u.id, "username": u.username}
-                st.session_state["perms"] = get_user_permissions(s, u)
+                store_perms(get_user_permissions(s, u))
 
                 # Token na URL para manter login ao dar F5
                 tok = create_login_token(s, u.id)
@@ -194,64 +336,87 @@ def login_sidebar():
 # -----------------------
 # Placeholders e mensagens prontas
 # -----------------------
+# Só argumentos simples: o próprio template faz parte da chave, então salvar a config já invalida.
+# lru_cache em memória (st.cache_data serializaria argumentos e resultado a cada card).
+@functools.lru_cache(maxsize=2048)
+def _format_message(template: str, order_id: int, cliente: str, entrega: str, items_text: str, obs: str) -> str:
+    return template.format(
+        order_id=order_id, cliente=cliente, entrega=entrega, itens=items_text, obs=obs
+    )
+
 def render_message(template: str, order: Order, items_text: str) -> str:
     entrega = str(order.delivery_date) if order.delivery_date else "data a combinar"
     cliente = (order.client.name if order.client else "Cliente")
     obs = order.obs or ""
-    txt = template.format(
-        order_id=order.id, cliente=cliente, entrega=entrega, itens=items_text, obs=obs
-    )
-    return txt
+    return _format_message(template or "", order.id, cliente, entrega, items_text, obs)
 
 # -----------------------
 # Navegação
 # -----------------------
-def allowed_pages() -> List[str]:
+# Calculada uma vez por conjunto de permissões (store_perms descarta a anterior).
+def allowed_pages() -> Tuple[str, ...]:
     if "perms" not in st.session_state:
-        return []
-    pages = []
-    for label, perm in PAGE_PERMISSION.items():
-        if can(perm) or can("page.settings"):
-            pages.append(label)
+        return ()
+    pages = st.session_state.get("allowed_pages")
+    if pages is None:
+        full = can("page.settings")
+        pages = tuple(label for label, perm in PAGE_PERMISSION.items() if full or can(perm))
+        st.session_state["allowed_pages"] = pages
     return pages
 
 def app_header():
     st.title("🍰 Gestão de Confeitaria/Restaurante")
     # Removido subtítulo longo a pedido do usuário.
 
-def load_config() -> Config:
+@st.cache_resource(show_spinner=False, max_entries=1)
+def _cached_cfg(version: int) -> Config:
     with SessionLocal() as s:
         return get_or_create_default_config(s)
 
-def get_kanban_stages(cfg: Config) -> List[str]:
+# Config somente-leitura (objeto desanexado); para alterar, carregue numa sessão.
+def load_config() -> Config:
+    return _cached_cfg(_cache_versions()["config"])
+
+# lru_cache por texto do JSON; tupla para ninguém alterar o valor compartilhado
+@functools.lru_cache(maxsize=8)
+def _parse_kanban_stages(kanban_json: str) -> Tuple[str, ...]:
     try:
-        stages = json.loads(cfg.kanban_stages_json or "[]")
+        stages = json.loads(kanban_json or "[]")
         if isinstance(stages, list) and stages:
-            return stages
+            return tuple(stages)
     except Exception:
         pass
-    return DEFAULT_KANBAN_STAGES
+    return tuple(DEFAULT_KANBAN_STAGES)
+
+def get_kanban_stages(cfg: Config) -> Tuple[str, ...]:
+    return _parse_kanban_stages(cfg.kanban_stages_json or "")
 
 # -----------------------
 # Páginas — Dashboard, Ingredientes, Receitas
 # -----------------------
 def page_dashboard():
     st.subheader("Dashboard")
+    today = dt.date.today()
     with SessionLocal() as s:
-        total_orders = s.query(Order).count()
-        open_orders = s.query(Order).filter(Order.status != "ENTREGUE").count()
-        today = dt.date.today()
-        today_orders = s.query(Order).filter(Order.delivery_date == today).count()
-
-        revenue = s.query(Order).filter(Order.status == "ENTREGUE") \
-            .with_entities((Order.total).label("rev")).all()
-        revenue_sum = sum(x.rev or 0.0 for x in revenue)
-
-        loss_moves = s.query(StockMove).filter(StockMove.move_type == "LOSS").all()
-        loss_sum = sum((m.cost or 0.0) for m in loss_moves)
-
-        out_moves = s.query(StockMove).filter(StockMove.move_type == "OUT").all()
-        cost_out_sum = sum((m.cost or 0.0) for m in out_moves)
+        # agregados calculados no banco (uma ida por tabela)
+        total_orders, open_orders, today_orders, revenue_sum = s.execute(
+            select(
+                func.count(Order.id),
+                func.count(case((Order.status != "ENTREGUE", 1))),
+                func.count(case((Order.delivery_date == today, 1))),
+                func.coalesce(func.sum(case((Order.status == "ENTREGUE", Order.total), else_=0.0)), 0.0),
+            )
+        ).one()
+
+        move_sums = dict(
+            s.execute(
+                select(StockMove.move_type, func.coalesce(func.sum(StockMove.cost), 0.0))
+                .where(StockMove.move_type.in_(["LOSS", "OUT"]))
+                .group_by(StockMove.move_type)
+            ).all()
+        )
+        loss_sum = move_sums.get("LOSS", 0.0)
+        cost_out_sum = move_sums.get("OUT", 0.0)
 
     c = st.columns(4)
     c[0].metric("Pedidos (total)", total_orders)
@@ -261,6 +426,45 @@ def page_dashboard():
     st.metric("Perdas (descartes)", fmt_money(loss_sum))
     st.metric("Custo consumido (estimado)", fmt_money(cost_out_sum))
 
+@st.fragment
+def _ingredient_edit_fragment():
+    with SessionLocal() as s:
+        st.markdown("### Editar Ingrediente")
+        all_ings = [tuple(r) for r in s.execute(select(Ingredient.id, Ingredient.name).order_by(Ingredient.name.asc())).all()]
+        ing_choice = st.selectbox("Selecione para editar", all_ings, format_func=lambda t: t[1] if t else "-")
+        ing_sel = s.get(Ingredient, ing_choice[0]) if ing_choice else None
+        if ing_sel:
+            c1, c2, c3 = st.columns([3, 1, 1])
+            new_name = c1.text_input("Nome", value=ing_sel.name, key=f"ing_edit_name_{ing_sel.id}")
+            new_unit = c2.selectbox(
+                "Unidade padrão",
+                ["g", "un"],
+                index=(0 if ( ing_sel.unit or "g") == "g" else 1),
+                key=f"ing_edit_unit_{ing_sel.id}",
+            )
+            new_active = c3.checkbox("Ativo", value=bool(ing_sel.is_active), key=f"ing_edit_active_{ing_sel.id}")
+            if st.button("Salvar alterações", key=f"ing_edit_save_{ing_sel.id}"):
+                if not can("ingredient.update"):
+                    toast_err("Sem permissão.")
+                else:
+                    ing_sel.name = (new_name or ing_sel.name).strip()
+                    ing_sel.unit = new_unit
+                    ing_sel.is_active = new_active
+                    s.commit()
+                    bump_cache_version("ingredients")
+                    toast_ok("Ingrediente atualizado.")
+                    st.rerun(scope="fragment")
+
+        st.markdown("### Lista")
+        ings = (
+            s.query(Ingredient)
+            .order_by(Ingredient.is_active.desc(), Ingredient.name.asc())
+            .with_entities(Ingredient.id, Ingredient.name, Ingredient.unit, Ingredient.is_active)
+            .all()
+        )
+        df = pd.DataFrame(ings, columns=["ID", "Nome", "Unidade", "Ativo"])
+        st.dataframe(df, hide_index=True, use_container_width=True)
+
 def page_ingredients():
     st.subheader("Ingredientes")
     if not can("page.ingredients"):
@@ -289,44 +493,11 @@ def page_ingredients():
                         else:
                             s.add(Ingredient(name=name, unit=unit, is_active=active))
                             s.commit()
-                            cached_ingredients.clear()
+                            bump_cache_version("ingredients")
                             toast_ok("Ingrediente criado.")
                             st.rerun()
 
-            st.markdown("### Editar Ingrediente")
-            all_ings = s.query(Ingredient).order_by(Ingredient.name.asc()).all()
-            ing_sel = st.selectbox("Selecione para editar", all_ings, format_func=lambda i: i.name if i else "-")
-            if ing_sel:
-                c1, c2, c3 = st.columns([3, 1, 1])
-                new_name = c1.text_input("Nome", value=ing_sel.name, key=f"ing_edit_name_{ing_sel.id}")
-                new_unit = c2.selectbox(
-                    "Unidade padrão",
-                    ["g", "un"],
-                    index=(0 if ( ing_sel.unit or "g") == "g" else 1),
-                    key=f"ing_edit_unit_{ing_sel.id}",
-                )
-                new_active = c3.checkbox("Ativo", value=bool(ing_sel.is_active), key=f"ing_edit_active_{ing_sel.id}")
-                if st.button("Salvar alterações", key=f"ing_edit_save_{ing_sel.id}"):
-                    if not can("ingredient.update"):
-                        toast_err("Sem permissão.")
-                    else:
-                        ing_sel.name = (new_name or ing_sel.name).strip()
-                        ing_sel.unit = new_unit
-                        ing_sel.is_active = new_active
-                        s.commit()
-                        cached_ingredients.clear()
-                        toast_ok("Ingrediente atualizado.")
-                        st.rerun()
-
-            st.markdown("### Lista")
-            ings = (
-                s.query(Ingredient)
-                .order_by(Ingredient.is_active.desc(), Ingredient.name.asc())
-                .with_entities(Ingredient.id, Ingredient.name, Ingredient.unit, Ingredient.is_active)
-                .all()
-            )
-            df = pd.DataFrame(ings, columns=["ID", "Nome", "Unidade", "Ativo"])
-            st.dataframe(df, hide_index=True, use_container_width=True)
+            _ingredient_edit_fragment()
 
         # ---------------- Tab 2: Compra por Lote ----------------
         with tab2:
@@ -353,18 +524,16 @@ def page_ingredients():
                         st.rerun()
 
             st.markdown("### Estoque por Lotes (resumo)")
-            lots = (
-                s.query(StockLot)
+            lots = s.execute(
+                select(StockLot.id, Ingredient.name, StockLot.qty_remaining, StockLot.unit, StockLot.best_before)
+                .join(Ingredient, Ingredient.id == StockLot.ingredient_id, isouter=True)
                 .order_by(StockLot.best_before.is_(None), StockLot.best_before.asc(), StockLot.created_at.asc())
-                .with_entities(StockLot.id, StockLot.ingredient_id, StockLot.qty_remaining, StockLot.unit, StockLot.best_before)
-                .all()
-            )
-            id_to_ing = {i.id: i.name for i in s.query(Ingredient).all()}
-            rows = [
-                {"Lote": lid, "Ingrediente": id_to_ing.get(iid, "?"), "Qtd restante": qty, "Un": u, "Validade": bb}
-                for lid, iid, qty, u, bb in lots
-            ]
-            st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+            ).all()
+            df_lots = pd.DataFrame.from_records(
+                lots, columns=["Lote", "Ingrediente", "Qtd restante", "Un", "Validade"]
+            ).astype({"Qtd restante": "float64"})
+            df_lots["Ingrediente"] = df_lots["Ingrediente"].fillna("?")
+            st.dataframe(df_lots, hide_index=True, use_container_width=True)
 
         # ---------------- Tab 3: Histórico de Preços (somente consulta) ----------------
        # ---------------- Tab 3: Histórico de Preços (somente consulta) ----------------
@@ -377,50 +546,27 @@ def page_ingredients():
                 ing_names = [n for _, n, _ in ing_opts]
                 sel_name = st.selectbox("Ingrediente", ing_names, key="price_hist_ing_view")
                 # consultar preços do ingrediente escolhido
-                q = (
-                    s.query(IngredientPrice)
+                stmt = (
+                    select(IngredientPrice.created_at.label("Quando"), IngredientPrice.price.label("Preço/un"))
                     .join(Ingredient, IngredientPrice.ingredient_id == Ingredient.id)
-                    .filter(Ingredient.name == sel_name)
+                    .where(Ingredient.name == sel_name)
                     .order_by(IngredientPrice.created_at.desc())
                     .limit(400)
                 )
-                prices = q.all()
-                rows = [{"Quando": p.created_at, "Preço/un": p.price} for p in prices]
-                st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+                df_prices = pd.read_sql_query(stmt, s.connection(), dtype={"Preço/un": "float64"})
+                st.dataframe(df_prices, hide_index=True, use_container_width=True)
                 
-def page_recipes():
-    st.subheader("Receitas")
-    if not can("page.recipes"):
-        st.info("Sem permissão.")
-        return
+@st.fragment
+def _recipe_items_fragment():
     with SessionLocal() as s:
-        st.markdown("### Nova Receita")
-        with st.form("rec_new"):
-            name = st.text_input("Nome da receita")
-            yield_qty = st.number_input("Rendimento (quantidade total)", min_value=0.0, value=1.0)
-            unit = st.selectbox("Unidade do rendimento", ["un", "g"])
-            ok = st.form_submit_button("Criar")
-            if ok:
-                if not can("recipe.create"):
-                    toast_err("Sem permissão.")
-                elif not name:
-                    toast_err("Informe o nome.")
-                else:
-                    if s.query(Recipe).filter(Recipe.name == name).first():
-                        toast_err("Já existe.")
-                    else:
-                        s.add(Recipe(name=name, yield_qty=yield_qty, unit=unit, is_active=True))
-                        s.commit()
-                        toast_ok("Receita criada.")
-                        st.rerun()
-
         st.markdown("### Itens da Receita")
-        recs = s.query(Recipe).order_by(Recipe.name.asc()).all()
+        recs = [tuple(r) for r in s.execute(select(Recipe.id, Recipe.name).order_by(Recipe.name.asc())).all()]
         if not recs:
             st.info("Crie uma receita acima.")
             return
 
-        rec_sel = st.selectbox("Selecione a receita", recs, format_func=lambda r: r.name if r else "-")
+        rec_choice = st.selectbox("Selecione a receita", recs, format_func=lambda t: t[1] if t else "-")
+        rec_sel = s.get(Recipe, rec_choice[0]) if rec_choice else None
         if rec_sel:
             # editar cabeçalho da receita
             e1, e2, e3, e4 = st.columns([3,1,1,1])
@@ -438,7 +584,7 @@ def page_recipes():
                     rec_sel.is_active = new_active
                     s.commit()
                     toast_ok("Receita atualizada.")
-                    st.rerun()
+                    st.rerun(scope="fragment")
 
             st.write(f"Rendimento atual: {rec_sel.yield_qty} {rec_sel.unit}")
 
@@ -452,82 +598,97 @@ def page_recipes():
                 if opt == "Ingrediente":
                     ingr = st.selectbox("Ingrediente", ing_opts, format_func=lambda t: t[1], key=f"rec_ing_sel_{rec_sel.id}")
                 else:
-                    subr = st.selectbox("Sub-receita", [r for r in recs if r.id != rec_sel.id], format_func=lambda r: r.name, key=f"rec_sub_sel_{rec_sel.id}")
+                    subr = st.selectbox("Sub-receita", [t for t in recs if t[0] != rec_sel.id], format_func=lambda t: t[1], key=f"rec_sub_sel_{rec_sel.id}")
                 ok_add = st.form_submit_button("Adicionar item")
                 if ok_add:
                     if opt == "Ingrediente" and ingr:
                         s.add(RecipeItem(recipe_id=rec_sel.id, ingredient_id=ingr[0], qty=qty, item_type=item_type))
                     elif opt == "Sub-receita" and subr:
-                        s.add(RecipeItem(recipe_id=rec_sel.id, sub_recipe_id=subr.id, qty=qty, item_type=item_type))
+                        s.add(RecipeItem(recipe_id=rec_sel.id, sub_recipe_id=subr[0], qty=qty, item_type=item_type))
                     s.commit()
                     toast_ok("Item adicionado.")
-                    st.rerun()
+                    st.rerun(scope="fragment")
 
             st.markdown("#### Itens")
-            items = s.query(RecipeItem).filter(RecipeItem.recipe_id==rec_sel.id).order_by(RecipeItem.id.asc()).all()
-            for it in items:
-                with st.container(border=True):
-                    if it.ingredient:
-                        st.write(f"Ingrediente: **{it.ingredient.name}** • Qtd: {it.qty} • Medida: {it.item_type}")
-                    elif it.sub_recipe:
-                        st.write(f"Sub-receita: **{it.sub_recipe.name}** • Qtd: {it.qty} • Medida: {it.item_type}")
+            SubRecipe = aliased(Recipe)
+            items = s.execute(
+                select(RecipeItem.id, Ingredient.name, SubRecipe.name, RecipeItem.qty, RecipeItem.item_type)
+                .outerjoin(Ingredient, Ingredient.id == RecipeItem.ingredient_id)
+                .outerjoin(SubRecipe, SubRecipe.id == RecipeItem.sub_recipe_id)
+                .where(RecipeItem.recipe_id == rec_sel.id)
+                .order_by(RecipeItem.id.asc())
+            ).all()
+            rows = [
+                (iid, ("Ingrediente" if ing_name else "Sub-receita" if sub_name else "?"), ing_name or sub_name or "?", qty, kind)
+                for iid, ing_name, sub_name, qty, kind in items
+            ]
+            st.dataframe(
+                pd.DataFrame.from_records(rows, columns=["ID", "Tipo", "Item", "Qtd", "Medida"]),
+                hide_index=True, use_container_width=True,
+            )
+            if rows:
+                # um único editor montado por vez
+                with st.expander("Editar / remover item"):
+                    it_row = st.selectbox(
+                        "Item a editar", rows,
+                        format_func=lambda r: f"{r[2]} • {r[3]} ({r[4]})",
+                        key=f"ri_sel_{rec_sel.id}",
+                    )
+                    new_qty = st.number_input("Qtd", min_value=0.0, step=0.1, value=float(it_row[3]), key=f"ri_qty_{it_row[0]}")
                     c1, c2 = st.columns(2)
-                    new_qty = c1.number_input("Qtd", min_value=0.0, step=0.1, value=float(it.qty), key=f"ri_qty_{it.id}")
-                    if c1.button("Salvar", key=f"ri_save_{it.id}"):
-                        it.qty = new_qty; s.commit(); toast_ok("Item atualizado."); st.rerun()
-                    if c2.button("Remover", key=f"ri_del_{it.id}"):
-                        s.delete(it); s.commit(); toast_ok("Item removido."); st.rerun()
-
+                    if c1.button("Salvar", key=f"ri_save_{it_row[0]}"):
+                        it = s.get(RecipeItem, it_row[0])
+                        it.qty = new_qty; s.commit(); toast_ok("Item atualizado."); st.rerun(scope="fragment")
+                    if c2.button("Remover", key=f"ri_del_{it_row[0]}"):
+                        s.delete(s.get(RecipeItem, it_row[0])); s.commit(); toast_ok("Item removido."); st.rerun(scope="fragment")
 
-# -----------------------
-# Páginas — Produtos, Clientes, Pedidos (Novo), Kanban
-# -----------------------
-def page_products():
-    st.subheader("Produtos")
-    if not can("page.products"):
+def page_recipes():
+    st.subheader("Receitas")
+    if not can("page.recipes"):
         st.info("Sem permissão.")
         return
-    with SessionLocal() as s:
-        recs = s.query(Recipe).order_by(Recipe.name.asc()).all()
-        st.markdown("### Novo Produto")
-        with st.form("prod_new"):
-            name = st.text_input("Nome do produto")
-            recipe = st.selectbox("Receita base (opcional)", [None] + recs, format_func=lambda r: r.name if r else "-")
-            price_manual = st.number_input("Preço manual (deixe 0 para sugerido)", min_value=0.0, value=0.0, step=0.01)
-            ok = st.form_submit_button("Criar")
-            if ok:
-                if not can("product.create"):
-                    toast_err("Sem permissão.")
-                elif not name:
-                    toast_err("Nome obrigatório.")
-                else:
-                    if s.query(Product).filter(Product.name == name).first():
+    st.markdown("### Nova Receita")
+    with st.form("rec_new"):
+        name = st.text_input("Nome da receita")
+        yield_qty = st.number_input("Rendimento (quantidade total)", min_value=0.0, value=1.0)
+        unit = st.selectbox("Unidade do rendimento", ["un", "g"])
+        ok = st.form_submit_button("Criar")
+        if ok:
+            if not can("recipe.create"):
+                toast_err("Sem permissão.")
+            elif not name:
+                toast_err("Informe o nome.")
+            else:
+                with SessionLocal() as s:
+                    if s.query(Recipe).filter(Recipe.name == name).first():
                         toast_err("Já existe.")
                     else:
-                        s.add(Product(
-                            name=name,
-                            recipe_id=(recipe.id if recipe else None),
-                            is_active=True,
-                            price_manual=(price_manual or None) if price_manual > 0 else None
-                        ))
+                        s.add(Recipe(name=name, yield_qty=yield_qty, unit=unit, is_active=True))
                         s.commit()
-                        cached_products.clear()
-                        toast_ok("Produto criado.")
+                        toast_ok("Receita criada.")
                         st.rerun()
 
+    _recipe_items_fragment()
+
+# -----------------------
+# Páginas — Produtos, Clientes, Pedidos (Novo), Kanban
+# -----------------------
+@st.fragment
+def _product_edit_fragment(recs):
+    with SessionLocal() as s:
         st.markdown("### Editar produto")
-        allp = s.query(Product).order_by(Product.name.asc()).all()
-        psel = st.selectbox("Selecione", allp, format_func=lambda p: p.name if p else "-")
+        allp = [tuple(r) for r in s.execute(select(Product.id, Product.name).order_by(Product.name.asc())).all()]
+        p_choice = st.selectbox("Selecione", allp, format_func=lambda t: t[1] if t else "-")
+        psel = s.get(Product, p_choice[0]) if p_choice else None
         if psel:
             c1, c2, c3, c4 = st.columns([3,2,1,1])
             new_name = c1.text_input("Nome", value=psel.name, key=f"pname_{psel.id}")
 
             # ↓↓↓ CORREÇÃO AQUI (índice seguro por ID)
-            recs = s.query(Recipe).order_by(Recipe.name.asc()).all()
             rec_choices = [None] + recs
             if psel.recipe_id:
                 try:
-                    idx = 1 + next(i for i, r in enumerate(recs) if r.id == psel.recipe_id)
+                    idx = 1 + next(i for i, r in enumerate(recs) if r[0] == psel.recipe_id)
                 except StopIteration:
                     idx = 0
             else:
@@ -536,7 +697,7 @@ def page_products():
                 "Receita",
                 rec_choices,
                 index=idx,
-                format_func=lambda r: (r.name if r else "-"),
+                format_func=lambda t: (t[1] if t else "-"),
                 key=f"prec_{psel.id}",
             )
             # ↑↑↑ FIM DA CORREÇÃO
@@ -548,43 +709,59 @@ def page_products():
                     toast_err("Sem permissão.")
                 else:
                     psel.name = (new_name or "").strip() or psel.name
-                    psel.recipe_id = new_rec.id if new_rec else None
+                    psel.recipe_id = new_rec[0] if new_rec else None
                     psel.price_manual = new_price_manual if new_price_manual > 0 else None
                     psel.is_active = new_active
                     s.commit()
-                    cached_products.clear()
+                    bump_cache_version("products")
                     toast_ok("Produto atualizado.")
-                    st.rerun()
-
+                    st.rerun(scope="fragment")
 
-def page_clients():
-    st.subheader("Clientes")
-    if not can("page.clients"):
+def page_products():
+    st.subheader("Produtos")
+    if not can("page.products"):
         st.info("Sem permissão.")
         return
     with SessionLocal() as s:
-        st.markdown("### Novo Cliente")
-        with st.form("cli_new"):
-            name = st.text_input("Nome")
-            phone = st.text_input("Telefone")
-            address = st.text_input("Endereço")
-            notes = st.text_area("Notas")
-            ok = st.form_submit_button("Salvar")
+        recs = [tuple(r) for r in s.execute(select(Recipe.id, Recipe.name).order_by(Recipe.name.asc())).all()]
+        st.markdown("### Novo Produto")
+        with st.form("prod_new"):
+            name = st.text_input("Nome do produto")
+            recipe = st.selectbox("Receita base (opcional)", [None] + recs, format_func=lambda t: t[1] if t else "-")
+            price_manual = st.number_input("Preço manual (deixe 0 para sugerido)", min_value=0.0, value=0.0, step=0.01)
+            ok = st.form_submit_button("Criar")
             if ok:
-                if not can("client.create"):
+                if not can("product.create"):
                     toast_err("Sem permissão.")
                 elif not name:
-                    toast_err("Informe o nome.")
+                    toast_err("Nome obrigatório.")
                 else:
-                    s.add(Client(name=name, phone=phone, address=address, notes=notes, is_active=True))
-                    s.commit()
-                    cached_clients.clear()
-                    toast_ok("Cliente criado.")
-                    st.rerun()
+                    if s.query(Product).filter(Product.name == name).first():
+                        toast_err("Já existe.")
+                    else:
+                        s.add(Product(
+                            name=name,
+                            recipe_id=(recipe[0] if recipe else None),
+                            is_active=True,
+                            price_manual=(price_manual or None) if price_manual > 0 else None
+                        ))
+                        s.commit()
+                        bump_cache_version("products")
+                        toast_ok("Produto criado.")
+                        st.rerun()
+
+    _product_edit_fragment(recs)
+
+
+CLIENTS_PAGE_SIZE = 50
 
+@st.fragment
+def _client_edit_fragment():
+    with SessionLocal() as s:
         st.markdown("### Editar Cliente")
-        cs = s.query(Client).order_by(Client.name.asc()).all()
-        sel = st.selectbox("Selecione", cs, format_func=lambda c: c.name if c else "-")
+        cs = [tuple(r) for r in s.execute(select(Client.id, Client.name).order_by(Client.name.asc())).all()]
+        cli_choice = st.selectbox("Selecione", cs, format_func=lambda t: t[1] if t else "-")
+        sel = s.get(Client, cli_choice[0]) if cli_choice else None
         if sel:
             c1, c2 = st.columns([2, 1])
             new_name = c1.text_input("Nome", value=sel.name, key=f"cli_name_{sel.id}")
@@ -602,52 +779,86 @@ def page_clients():
                     sel.notes = new_notes
                     sel.is_active = new_active
                     s.commit()
-                    cached_clients.clear()
+                    bump_cache_version("clients")
                     toast_ok("Cliente atualizado.")
-                    st.rerun()
+                    st.rerun(scope="fragment")
 
         st.markdown("### Busca")
-        q = st.text_input("Pesquisar por nome")
-        query = s.query(Client)
-        if q:
-            query = query.filter(Client.name.ilike(f"%{q}%"))
-        clients = query.order_by(Client.is_active.desc(), Client.name.asc()).limit(500).all()
-        rows = [{"ID": c.id, "Nome": c.name, "Telefone": c.phone, "Ativo": c.is_active} for c in clients]
-        st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+        q = (st.text_input("Pesquisar por nome") or "").strip()
+        stmt = select(Client.id, Client.name, Client.phone, Client.is_active)
+        if len(q) >= 2:
+            # no Postgres usa o índice trigram ix_client_name_trgm
+            stmt = stmt.where(Client.name.ilike(f"%{q}%"))
+        elif q:
+            st.caption("Digite ao menos 2 letras para filtrar.")
+        page = st.number_input("Página", min_value=1, step=1, value=1, key="cli_page")
+        clients = s.execute(
+            stmt.order_by(Client.is_active.desc(), Client.name.asc())
+            .limit(CLIENTS_PAGE_SIZE).offset((int(page) - 1) * CLIENTS_PAGE_SIZE)
+        ).all()
+        st.dataframe(
+            pd.DataFrame.from_records(clients, columns=["ID", "Nome", "Telefone", "Ativo"]),
+            hide_index=True, use_container_width=True,
+        )
+
+def page_clients():
+    st.subheader("Clientes")
+    if not can("page.clients"):
+        st.info("Sem permissão.")
+        return
+    st.markdown("### Novo Cliente")
+    with st.form("cli_new"):
+        name = st.text_input("Nome")
+        phone = st.text_input("Telefone")
+        address = st.text_input("Endereço")
+        notes = st.text_area("Notas")
+        ok = st.form_submit_button("Salvar")
+        if ok:
+            if not can("client.create"):
+                toast_err("Sem permissão.")
+            elif not name:
+                toast_err("Informe o nome.")
+            else:
+                with SessionLocal() as s:
+                    s.add(Client(name=name, phone=phone, address=address, notes=notes, is_active=True))
+                    s.commit()
+                bump_cache_version("clients")
+                toast_ok("Cliente criado.")
+                st.rerun()
+
+    _client_edit_fragment()
 
-def _order_total(items: List[OrderItem]) -> float:
-    return sum((it.unit_price or 0.0) * (it.qty or 0.0) for it in items)
 
 def page_order_new():
     st.subheader("Novo Pedido")
     if not can("page.orders.new"):
         st.info("Sem permissão.")
         return
-    with SessionLocal() as s:
-        cl_opts = cached_clients()
-        pr_opts = cached_products()
-        with st.form("order_new"):
-            client = st.selectbox("Cliente", cl_opts, format_func=lambda t: t[1] if t else "-")
-            delivery = st.date_input("Data de entrega", value=dt.date.today())
-            obs = st.text_area("Observações")
-            st.markdown("**Itens**")
-            item_rows = st.number_input("Quantos itens adicionar nesta tela?", min_value=1, max_value=10, value=1)
-            entries = []
-            for i in range(int(item_rows)):
-                cols = st.columns((3, 1, 1))
-                prod = cols[0].selectbox(f"Produto #{i+1}", pr_opts, key=f"prod_{i}", format_func=lambda t: t[1])
-                qty = cols[1].number_input(f"Qtd #{i+1}", min_value=0.0, step=1.0, value=1.0, key=f"qty_{i}")
-                price = cols[2].number_input(f"Preço unit. #{i+1}", min_value=0.0, step=0.01, value=0.0, key=f"price_{i}")
-                entries.append((prod, qty, price))
-            paid = st.checkbox("Pago?")
-            submit = st.form_submit_button("Criar Pedido")
-            if submit:
-                if not can("order.create"):
-                    toast_err("Sem permissão.")
-                    return
-                if not entries:
-                    toast_err("Adicione ao menos um item.")
-                    return
+    cl_opts = cached_clients()
+    pr_opts = cached_products()
+    with st.form("order_new"):
+        client = st.selectbox("Cliente", cl_opts, format_func=lambda t: t[1] if t else "-")
+        delivery = st.date_input("Data de entrega", value=dt.date.today())
+        obs = st.text_area("Observações")
+        st.markdown("**Itens**")
+        item_rows = st.number_input("Quantos itens adicionar nesta tela?", min_value=1, max_value=10, value=1)
+        entries = []
+        for i in range(int(item_rows)):
+            cols = st.columns((3, 1, 1))
+            prod = cols[0].selectbox(f"Produto #{i+1}", pr_opts, key=f"prod_{i}", format_func=lambda t: t[1])
+            qty = cols[1].number_input(f"Qtd #{i+1}", min_value=0.0, step=1.0, value=1.0, key=f"qty_{i}")
+            price = cols[2].number_input(f"Preço unit. #{i+1}", min_value=0.0, step=0.01, value=0.0, key=f"price_{i}")
+            entries.append((prod, qty, price))
+        paid = st.checkbox("Pago?")
+        submit = st.form_submit_button("Criar Pedido")
+        if submit:
+            if not can("order.create"):
+                toast_err("Sem permissão.")
+                return
+            if not entries:
+                toast_err("Adicione ao menos um item.")
+                return
+            with SessionLocal() as s:
                 o = Order(
                     client_id=client[0] if client else None,
                     delivery_date=delivery,
@@ -657,23 +868,129 @@ def page_order_new():
                     total=0.0
                 )
                 s.add(o); s.flush()
-                cfg = get_or_create_default_config(s)
+                cfg = load_config()
+                cost_map = estimate_unit_costs_bulk(s, [int(prod[0]) for prod, _, _ in entries])
+                rows = []
+                total = 0.0  # só para a mensagem; o total gravado é somado pelo banco
                 for (prod, qty, price) in entries:
-                    p = s.get(Product, int(prod[0]))
-                    cost = estimate_product_unit_cost(s, p)
-                    it = OrderItem(
-                        order_id=o.id,
-                        product_id=p.id,
-                        qty=qty,
-                        unit_price=price if price > 0 else cost * (1.0 + (cfg.margin_default or 0.60)),
-                        unit_cost_snapshot=cost
-                    )
-                    s.add(it)
-                s.flush()
-                o.total = _order_total(o.items)
+                    pid = int(prod[0])
+                    cost = cost_map.get(pid, 0.0)
+                    unit_price = price if price > 0 else cost * (1.0 + (cfg.margin_default or 0.60))
+                    rows.append({
+                        "order_id": o.id,
+                        "product_id": pid,
+                        "qty": qty,
+                        "unit_price": unit_price,
+                        "unit_cost_snapshot": cost,
+                    })
+                    total += unit_price * qty
+                # um único INSERT multi-linha para os itens
+                s.execute(insert(OrderItem), rows)
+                # Postgres com trigger já atualizou o total; sem trigger, recalcula no banco
+                if not order_total_trigger_active():
+                    recompute_order_total(s, o.id)
                 s.commit()
-                toast_ok(f"Pedido #{o.id} criado com total {fmt_money(o.total)}.")
-                st.rerun()
+            toast_ok(f"Pedido #{o.id} criado com total {fmt_money(total)}.")
+            st.rerun()
+
+# Carregamento antecipado dos cards de pedido (evita N+1 em client/items/product).
+# BAKERY_DEBUG_RAISELOAD=1 faz qualquer lazy load restante estourar erro
+# e mostra na sidebar quantas consultas SQL a página executou.
+_DEBUG_RAISELOAD = bool(os.getenv("BAKERY_DEBUG_RAISELOAD"))
+
+KANBAN_COLUMN_LIMIT = 50
+
+# Itens de pedido não mudam após criado; só estoque/receitas alteram as faltas.
+@st.cache_data(show_spinner=False, max_entries=512)
+def _shortages_cached(order_id: int, stock_ver: int) -> List[Tuple[str, float]]:
+    with SessionLocal() as s:
+        o = s.get(Order, order_id)
+        if not o:
+            return []
+        return [(ing.name, qtd) for ing, qtd in ingredient_shortages(s, o) if ing]
+
+def order_card_options(with_items: bool = True) -> list:
+    opts = [joinedload(Order.client)]
+    if with_items:
+        opts.append(selectinload(Order.items).joinedload(OrderItem.product))
+    if _DEBUG_RAISELOAD:
+        opts.append(raiseload("*"))
+    return opts
+
+# Cada card é um fragmento: marcar pago re-renderiza só o card; mover/cancelar muda a
+# coluna do pedido e então reexecuta a página. `o` chega já carregado (desanexado).
+@st.fragment
+def _kanban_card(o: Order, stage: str, nexts: List[str], msg_producao: str, msg_pronto: str, consume_stage: str):
+    with st.container(border=True):
+        cli_name = o.client.name if o.client else "—"
+        items_txt = ", ".join([f"{it.qty}x {(it.product.name if it.product else '??')}" for it in o.items])
+        st.markdown(f"**#{o.id}** — {cli_name}")
+        st.caption(f"Itens: {items_txt}")
+        st.caption(f"Total: {fmt_money(o.total or 0.0)}  •  Entrega: {o.delivery_date or '-'}")
+
+        # Faltas
+        sh = _shortages_cached(o.id, stock_version())
+        if sh:
+            st.warning("Faltando: " + ", ".join([f"{name} ({qtd:.2f})" for name, qtd in sh]))
+
+        # Pago toggle
+        colp1, colp2 = st.columns(2)
+        if colp1.button(("✓ Desmarcar Pago" if o.paid else "💰 Marcar Pago"), key=f"paid_{stage}_{o.id}"):
+            if (o.paid and can("order.unmark_paid")) or ((not o.paid) and can("order.mark_paid")):
+                with SessionLocal() as s:
+                    # valor explícito (não ~paid): é o estado que a checagem de permissão validou
+                    s.execute(update(Order).where(Order.id == o.id).values(paid=not o.paid))
+                    s.commit()
+                o.paid = not o.paid  # reflete no objeto que o fragmento reutiliza
+                toast_ok("Status de pagamento atualizado.")
+                st.rerun(scope="fragment")
+            else:
+                toast_err("Sem permissão.")
+
+        # Mensagens
+        msg_cols = st.columns(2)
+        prod_msg = render_message(msg_producao, o, items_txt)
+        pronto_msg = render_message(msg_pronto, o, items_txt)
+        with msg_cols[0]:
+            st.text_area("Mensagem: Produção", prod_msg, height=80, key=f"mprod_{o.id}")
+            copy_hint()
+        with msg_cols[1]:
+            st.text_area("Mensagem: Cliente (Pronto)", pronto_msg, height=80, key=f"mpronto_{o.id}")
+            copy_hint()
+
+        # Mover estágio
+        if nexts:
+            mv = st.selectbox("Mover para:", ["-"] + nexts, key=f"mv_{o.id}")
+            if mv != "-" and st.button("Mover", key=f"btn_mv_{o.id}"):
+                if can("order.move_stage"):
+                    entering_consume = (mv == consume_stage and o.status != consume_stage)
+                    with SessionLocal() as s:
+                        s.execute(update(Order).where(Order.id == o.id).values(status=mv))
+                        s.commit()
+                        if entering_consume and can("order.consume_fifo"):
+                            res = consume_fifo_for_order(s, s.get(Order, o.id))
+                            faltantes = {ing_id: miss for ing_id, (_, miss) in res.items() if miss > 1e-9}
+                            if faltantes:
+                                st.warning("Consumo aplicado com faltas em alguns ingredientes.")
+                            toast_ok("Estoque consumido (FIFO).")
+                    st.rerun()
+                else:
+                    toast_err("Sem permissão.")
+
+        # Cancelar
+        if st.button("Cancelar", key=f"cancel_{o.id}"):
+            just = st.text_input("Justificativa do cancelamento", key=f"just_{o.id}")
+            if st.button("Confirmar cancelamento", key=f"cnf_cancel_{o.id}"):
+                if not can("order.cancel"):
+                    toast_err("Sem permissão.")
+                else:
+                    with SessionLocal() as s:
+                        s.execute(update(Order).where(Order.id == o.id).values(
+                            status="CANCELADO", canceled_reason=just or "Sem justificativa."
+                        ))
+                        s.commit()
+                    toast_ok("Pedido cancelado.")
+                    st.rerun()
 
 def page_kanban():
     st.subheader("Kanban de Pedidos")
@@ -685,91 +1002,43 @@ def page_kanban():
     st.caption(f"Estágios: {', '.join(stages)}")
     col_top = st.columns(3)
     date_filter = col_top[0].date_input("Entrega em (filtro opcional)", value=None)
-    client_query = col_top[1].text_input("Cliente (contém)", value="")
+    client_query = (col_top[1].text_input("Cliente (contém)", value="") or "").strip()
     consume_stage = cfg.fifo_stage or "EM_PRODUCAO"
     st.caption(f"Consumo FIFO será aplicado ao entrar em: **{consume_stage}** (configurável).")
 
     with SessionLocal() as s:
+        # uma só consulta para todas as colunas; row_number limita cada estágio no banco
+        card_order = (Order.delivery_date.asc().nulls_last(), Order.created_at.asc())
+        ranked = select(
+            Order.id.label("id"),
+            func.row_number().over(partition_by=Order.status, order_by=card_order).label("rn"),
+        ).where(Order.status.in_(stages))
+        if date_filter:
+            ranked = ranked.where(Order.delivery_date == date_filter)
+        if client_query:
+            # join só com filtro; ILIKE usa ix_client_name_trgm no Postgres
+            ranked = ranked.join(Client, Client.id == Order.client_id)\
+                .where(Client.name.ilike(f"%{client_query}%"))
+        ranked = ranked.subquery()
+        rows = (
+            s.query(Order).options(*order_card_options())
+            .join(ranked, ranked.c.id == Order.id)
+            .filter(ranked.c.rn <= KANBAN_COLUMN_LIMIT)
+            .order_by(*card_order)
+            .all()
+        )
+        buckets: Dict[str, List[Order]] = {stage: [] for stage in stages}
+        for o in rows:
+            buckets[o.status].append(o)
+
         cols = st.columns(len(stages))
         for idx, stage in enumerate(stages):
+            # próximos estágios (avançar 1 ou pular 1) são constantes por coluna
+            nexts = list(stages[idx + 1:idx + 3]) if stage != "CANCELADO" else []
             with cols[idx]:
                 st.markdown(f"#### {stage}")
-                q = s.query(Order).filter(Order.status == stage)
-                if date_filter:
-                    q = q.filter(Order.delivery_date == date_filter)
-                if client_query:
-                    q = q.join(Client, isouter=True).filter(Client.name.ilike(f"%{client_query}%"))
-                orders = q.order_by(Order.delivery_date.asc().nulls_last(), Order.created_at.asc()).limit(50).all()
-                for o in orders:
-                    with st.container(border=True):
-                        cli_name = o.client.name if o.client else "—"
-                        items_txt = ", ".join([f"{it.qty}x {(it.product.name if it.product else '??')}" for it in o.items])
-                        st.markdown(f"**#{o.id}** — {cli_name}")
-                        st.caption(f"Itens: {items_txt}")
-                        st.caption(f"Total: {fmt_money(o.total or 0.0)}  •  Entrega: {o.delivery_date or '-'}")
-
-                        # Faltas
-                        sh = ingredient_shortages(s, o)
-                        if sh:
-                            st.warning("Faltando: " + ", ".join([f"{ing.name} ({qtd:.2f})" for ing, qtd in sh if ing]))
-
-                        # Pago toggle
-                        colp1, colp2 = st.columns(2)
-                        if colp1.button(("✓ Desmarcar Pago" if o.paid else "💰 Marcar Pago"), key=f"paid_{stage}_{o.id}"):
-                            if (o.paid and can("order.unmark_paid")) or ((not o.paid) and can("order.mark_paid")):
-                                o.paid = not o.paid
-                                s.commit()
-                                toast_ok("Status de pagamento atualizado.")
-                                st.rerun()
-                            else:
-                                toast_err("Sem permissão.")
-
-                        # Mensagens
-                        msg_cols = st.columns(2)
-                        prod_msg = render_message(cfg.msg_producao, o, items_txt)
-                        pronto_msg = render_message(cfg.msg_pronto, o, items_txt)
-                        with msg_cols[0]:
-                            st.text_area("Mensagem: Produção", prod_msg, height=80, key=f"mprod_{o.id}")
-                            copy_hint()
-                        with msg_cols[1]:
-                            st.text_area("Mensagem: Cliente (Pronto)", pronto_msg, height=80, key=f"mpronto_{o.id}")
-                            copy_hint()
-
-                        # Mover estágio
-                        if stage != "CANCELADO":
-                            i_stage = stages.index(stage)
-                            nexts = []
-                            if i_stage + 1 < len(stages): nexts.append(stages[i_stage + 1])
-                            if i_stage + 2 < len(stages): nexts.append(stages[i_stage + 2])  # pular
-                            if nexts:
-                                mv = st.selectbox("Mover para:", ["-"] + nexts, key=f"mv_{o.id}")
-                                if mv != "-" and st.button("Mover", key=f"btn_mv_{o.id}"):
-                                    if can("order.move_stage"):
-                                        entering_consume = (mv == consume_stage and o.status != consume_stage)
-                                        o.status = mv
-                                        s.commit()
-                                        if entering_consume and can("order.consume_fifo"):
-                                            res = consume_fifo_for_order(s, o)
-                                            faltantes = {ing_id: miss for ing_id, (_, miss) in res.items() if miss > 1e-9}
-                                            if faltantes:
-                                                st.warning("Consumo aplicado com faltas em alguns ingredientes.")
-                                            toast_ok("Estoque consumido (FIFO).")
-                                        st.rerun()
-                                    else:
-                                        toast_err("Sem permissão.")
-
-                        # Cancelar
-                        if st.button("Cancelar", key=f"cancel_{o.id}"):
-                            just = st.text_input("Justificativa do cancelamento", key=f"just_{o.id}")
-                            if st.button("Confirmar cancelamento", key=f"cnf_cancel_{o.id}"):
-                                if not can("order.cancel"):
-                                    toast_err("Sem permissão.")
-                                else:
-                                    o.status = "CANCELADO"
-                                    o.canceled_reason = just or "Sem justificativa."
-                                    s.commit()
-                                    toast_ok("Pedido cancelado.")
-                                    st.rerun()
+                for o in buckets[stage]:
+                    _kanban_card(o, stage, nexts, cfg.msg_producao, cfg.msg_pronto, consume_stage)
 
 # -----------------------
 # Páginas — Pós-venda, Calendário, Compras & Estoque, Importação, Descarte & Vencidos,
@@ -781,12 +1050,25 @@ def page_postsale():
         st.info("Sem permissão.")
         return
     stages = ["ENTREGUE","POS1","POS2","DONE"]
+    next_pos = {"ENTREGUE": "POS1", "POS1": "POS2", "POS2": "DONE"}
     cols = st.columns(4)
     with SessionLocal() as s:
+        # contagem por etapa numa única consulta; as colunas POS1/POS2 incluem a etapa anterior
+        by_pos = dict(
+            s.query(Order.pos_stage, func.count(Order.id))
+            .filter(Order.status=="ENTREGUE").group_by(Order.pos_stage).all()
+        )
+        counts = {
+            "ENTREGUE": by_pos.get("ENTREGUE", 0),
+            "POS1": by_pos.get("ENTREGUE", 0) + by_pos.get("POS1", 0),
+            "POS2": by_pos.get("POS1", 0) + by_pos.get("POS2", 0),
+            "DONE": by_pos.get("DONE", 0),
+        }
         for i, stage in enumerate(stages):
             with cols[i]:
-                st.markdown(f"### {stage}")
-                q = s.query(Order).filter(Order.status=="ENTREGUE")  # só após entregue
+                st.markdown(f"### {stage} ({counts[stage]})")
+                q = s.query(Order).outerjoin(Client, Client.id == Order.client_id)\
+                    .filter(Order.status=="ENTREGUE")  # só após entregue
                 # organiza pela data relevante da etapa
                 if stage == "POS1":
                     q = q.filter(Order.pos_stage.in_(["ENTREGUE","POS1"])).order_by(Order.pos1_date.asc().nulls_last(), Order.delivery_date.desc())
@@ -797,20 +1079,23 @@ def page_postsale():
                 else:
                     q = q.filter(Order.pos_stage=="ENTREGUE").order_by(Order.delivery_date.desc())
 
-                for o in q.limit(50).all():
+                rows = q.with_entities(
+                    Order.id, Client.name, Order.delivery_date, Order.pos_stage, Order.pos1_date, Order.pos2_date
+                ).limit(50).all()
+                for oid, cli_name, delivery, pos_stage, pos1_date, pos2_date in rows:
                     with st.container(border=True):
-                        st.markdown(f"**#{o.id}** — {o.client.name if o.client else '—'}")
-                        st.caption(f"Entrega: {o.delivery_date or '-'}")
+                        st.markdown(f"**#{oid}** — {cli_name or '—'}")
+                        st.caption(f"Entrega: {delivery or '-'}")
                         d1, d2 = st.columns(2)
-                        pos1 = d1.date_input("POS1 em", value=o.pos1_date, key=f"pos1_{o.id}")
-                        pos2 = d2.date_input("POS2 em", value=o.pos2_date, key=f"pos2_{o.id}")
-                        if st.button("Salvar datas", key=f"pos_save_{o.id}"):
+                        # o mesmo pedido pode aparecer em duas colunas: a chave inclui a etapa
+                        pos1 = d1.date_input("POS1 em", value=pos1_date, key=f"pos1_{stage}_{oid}")
+                        pos2 = d2.date_input("POS2 em", value=pos2_date, key=f"pos2_{stage}_{oid}")
+                        if st.button("Salvar datas", key=f"pos_save_{stage}_{oid}"):
+                            o = s.get(Order, oid)
                             o.pos1_date = pos1; o.pos2_date = pos2; s.commit(); toast_ok("Datas salvas.")
-                        nxt = None
-                        if o.pos_stage == "ENTREGUE": nxt = "POS1"
-                        elif o.pos_stage == "POS1": nxt = "POS2"
-                        elif o.pos_stage == "POS2": nxt = "DONE"
-                        if nxt and st.button(f"Avançar para {nxt}", key=f"pos_next_{o.id}"):
+                        nxt = next_pos.get(pos_stage)
+                        if nxt and st.button(f"Avançar para {nxt}", key=f"pos_next_{stage}_{oid}"):
+                            o = s.get(Order, oid)
                             o.pos_stage = nxt; s.commit(); toast_ok("Etapa atualizada."); st.rerun()
 
 def page_calendar():
@@ -820,10 +1105,15 @@ def page_calendar():
         return
     with SessionLocal() as s:
         day = st.date_input("Dia", value=dt.date.today())
-        orders = s.query(Order).filter(Order.delivery_date == day).order_by(Order.created_at.asc()).all()
+        orders = s.query(Order).options(*order_card_options(with_items=False))\
+            .filter(Order.delivery_date == day).order_by(Order.created_at.asc()).all()
         rows = [{"#": o.id, "Cliente": (o.client.name if o.client else "—"), "Status": o.status, "Pago": "Sim" if o.paid else "Não", "Total": fmt_money(o.total or 0.0)} for o in orders]
         st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def _sugg_csv(mp_id: int, ver: str, rows: Tuple[Tuple, ...]) -> bytes:
+    return pd.DataFrame(list(rows), columns=["Ingrediente", "Qtd", "Un"]).to_csv(index=False).encode("utf-8")
+
 def page_stock():
     st.subheader("Compras & Estoque")
     if not can("page.stock"):
@@ -831,6 +1121,10 @@ def page_stock():
         return
 
     with SessionLocal() as s:
+        # carregados uma vez e reaproveitados pelas seções abaixo
+        sup_all = s.query(Supplier).order_by(Supplier.name.asc()).all()
+        ing_opts = cached_ingredients()
+
         # ---------------- Fornecedores ----------------
         st.markdown("### Fornecedores")
         with st.form("sup_new"):
@@ -841,7 +1135,6 @@ def page_stock():
                     s.add(Supplier(name=sname, contact=scontact)); s.commit()
                     toast_ok("Fornecedor criado.")
                     st.rerun()
-        sup_all = s.query(Supplier).order_by(Supplier.name.asc()).all()
         if sup_all:
             sup_sel = st.selectbox("Editar fornecedor", [None] + sup_all, format_func=lambda x: x.name if x else "-")
             if sup_sel:
@@ -856,14 +1149,12 @@ def page_stock():
                     st.rerun()
 
         st.markdown("### Compra manual")
-        ing_opts = cached_ingredients()
         if not ing_opts:
             st.info("Cadastre ingredientes primeiro.")
         else:
             with st.form("purchase_form"):
                 # Fornecedor por dropdown
-                sup_list = s.query(Supplier).order_by(Supplier.name.asc()).all()
-                sup = st.selectbox("Fornecedor", [None] + sup_list, format_func=lambda x: x.name if x else "-")
+                sup = st.selectbox("Fornecedor", [None] + sup_all, format_func=lambda x: x.name if x else "-")
 
                 lines = st.number_input("Itens nesta compra", min_value=1, max_value=20, value=1)
                 entries = []
@@ -890,7 +1181,8 @@ def page_stock():
                         p = ManualPurchase(supplier_id=(sup.id if sup else None), total=0.0)
                         s.add(p); s.flush()
 
-                        from db import create_lot
+                        from db import bulk_create_lots
+                        lots_payload = []
                         # mapa id -> (nome, unidade)
                         ing_id_to_unit = {int(i): u for i, _, u in ing_opts}
                         for (sel, qty, unit, total_price, bb) in entries:
@@ -909,14 +1201,18 @@ def page_stock():
                                 )
                             )
 
-                            # cria o lote com custo unitário calculado
-                            create_lot(s, ing_id, qty, unit, unit_price, bb, note=f"Compra #{p.id}")
+                            # lote com custo unitário calculado (gravados juntos após o laço)
+                            lots_payload.append(dict(
+                                ingredient_id=ing_id, qty=qty, unit=unit, unit_price=unit_price,
+                                best_before=bb, note=f"Compra #{p.id}",
+                            ))
 
                             # grava histórico de preço (preço por unidade)
                             s.add(IngredientPrice(ingredient_id=ing_id, price=unit_price))
 
                             total_compra += (total_price or 0.0)
 
+                        bulk_create_lots(s, lots_payload, commit=False)
                         p.total = total_compra
                         s.commit()
                         toast_ok(f"Compra registrada (total {fmt_money(total_compra)}).")
@@ -925,7 +1221,8 @@ def page_stock():
 
         # ---------------- Ajustes / Vencidos ----------------
         st.markdown("### Ajustes / Vencidos")
-        lots = s.query(StockLot).order_by(
+        # ingrediente vem no mesmo JOIN; limit(200) já limita a página
+        lots = s.query(StockLot).options(joinedload(StockLot.ingredient)).order_by(
             StockLot.best_before.is_(None), StockLot.best_before.asc(), StockLot.created_at.asc()
         ).limit(200).all()
         for lot in lots:
@@ -950,16 +1247,12 @@ def page_stock():
             day_to = d2.date_input("Até", value=dt.date.today()+dt.timedelta(days=7))
             if st.button("Gerar sugestão"):
                 # calcula necessidade total no intervalo
-                open_orders = s.query(Order).filter(
+                open_order_ids = [oid for (oid,) in s.query(Order.id).filter(
                     Order.status.notin_(["CANCELADO","ENTREGUE"]),
                     Order.delivery_date >= day_from, Order.delivery_date <= day_to
-                ).all()
-                need: Dict[int,float] = {}
-                for o in open_orders:
-                    from db import required_ingredients_for_order
-                    req = required_ingredients_for_order(s, o)
-                    for k,v in req.items():
-                        need[k] = need.get(k,0.0) + v
+                ).all()]
+                from db import required_ingredients_for_orders
+                need: Dict[int,float] = required_ingredients_for_orders(s, open_order_ids)
                 # subtrai disponível
                 suggest = []
                 # ingredientes já sugeridos (listas abertas)
@@ -967,12 +1260,14 @@ def page_stock():
                     .filter(ManualPurchase.is_suggestion==True, ManualPurchase.completed_at.is_(None)).all()
                 already = set([x[0] for x in open_suggestions])
 
+                # disponível e unidade de todos os ingredientes necessários em 2 consultas
+                have_by_ing = available_quantities(s, need)
+                unit_by_ing = dict(
+                    s.query(Ingredient.id, Ingredient.unit).filter(Ingredient.id.in_(need.keys())).all()
+                ) if need else {}
+
                 for ing_id, req_qty in need.items():
-                    avail = s.query(StockLot).with_entities(StockLot.qty_remaining).filter(
-                        StockLot.ingredient_id==ing_id, StockLot.qty_remaining>0
-                    ).all()
-                    have = sum(x[0] for x in avail)
-                    miss = req_qty - have
+                    miss = req_qty - (have_by_ing.get(ing_id) or 0.0)
                     if miss > 0 and ing_id not in already:
                         suggest.append(( ing_id, miss ))
 
@@ -982,14 +1277,12 @@ def page_stock():
                     mp = ManualPurchase(is_suggestion=True, title=f"Sugestão {day_from}..{day_to}", total=0.0)
                     s.add(mp); s.flush()
                     for ing_id, miss in suggest:
-                        ing = s.get(Ingredient, ing_id)
-                        s.add(ManualPurchaseItem(purchase_id=mp.id, ingredient_id=ing_id, qty=miss, unit=ing.unit, price=0.0))
+                        s.add(ManualPurchaseItem(purchase_id=mp.id, ingredient_id=ing_id, qty=miss, unit=unit_by_ing.get(ing_id), price=0.0))
                     s.commit()
                     toast_ok(f"Sugestão criada #{mp.id}.")
                     st.rerun()
 
         with st.expander("Adicionar itens manualmente à lista de compra"):
-            ing_opts = cached_ingredients()
             if ing_opts:
                 ing = st.selectbox("Ingrediente", ing_opts, format_func=lambda t: t[1], key="man_sugg_ing")
                 qty = st.number_input("Quantidade a comprar", min_value=0.0, step=0.1, key="man_sugg_qty")
@@ -1010,17 +1303,22 @@ def page_stock():
         sugg = s.query(ManualPurchase).filter(ManualPurchase.is_suggestion==True).order_by(
             ManualPurchase.created_at.desc()
         ).limit(20).all()
+        # itens de todas as sugestões listadas, já com o nome do ingrediente
+        items_by_purchase: Dict[int, List[Dict]] = {mp.id: [] for mp in sugg}
+        if sugg:
+            sugg_items = s.query(
+                ManualPurchaseItem.purchase_id, Ingredient.name, ManualPurchaseItem.qty, ManualPurchaseItem.unit
+            ).outerjoin(Ingredient, Ingredient.id == ManualPurchaseItem.ingredient_id)\
+                .filter(ManualPurchaseItem.purchase_id.in_(items_by_purchase.keys()))\
+                .order_by(ManualPurchaseItem.id.asc()).all()
+            for purchase_id, ing_name, qty, unit in sugg_items:
+                items_by_purchase[purchase_id].append({"Ingrediente": ing_name or "?", "Qtd": qty, "Un": unit})
         for mp in sugg:
             with st.expander(f"Sugestão #{mp.id} — {mp.title or mp.created_at.date()}{' (aberta)' if not mp.completed_at else ''}"):
-                items = s.query(ManualPurchaseItem).filter(ManualPurchaseItem.purchase_id==mp.id).all()
-                rows = []
-                for it in items:
-                    ing = s.get(Ingredient, it.ingredient_id)
-                    rows.append({"Ingrediente": ing.name if ing else "?", "Qtd": it.qty, "Un": it.unit})
+                rows = items_by_purchase[mp.id]
                 st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
-                if st.button("Baixar CSV", key=f"csv_{mp.id}"):
-                    csv = pd.DataFrame(rows).to_csv(index=False).encode("utf-8")
-                    st.download_button("Download CSV", csv, file_name=f"sugestao_{mp.id}.csv", mime="text/csv", key=f"dl_{mp.id}")
+                csv = _sugg_csv(mp.id, str(mp.completed_at or ""), tuple((r["Ingrediente"], r["Qtd"], r["Un"]) for r in rows))
+                st.download_button("Baixar CSV", csv, file_name=f"sugestao_{mp.id}.csv", mime="text/csv", key=f"dl_{mp.id}")
                 if not mp.completed_at and st.button("Marcar como concluída", key=f"done_{mp.id}"):
                     mp.completed_at = dt.datetime.utcnow(); s.commit(); toast_ok("Marcada como concluída."); st.rerun()
 
@@ -1032,6 +1330,13 @@ def page_stock():
                 res = discard_expired(s)
                 toast_ok(f"Lotes processados: {len(res)}")
 
+def _csv_column(df: pd.DataFrame, *candidates: str, default: str = ""):
+    # primeira coluna existente entre os nomes aceitos, como array de str sem espaços
+    col = next((c for c in candidates if c in df.columns), None)
+    if col is None:
+        return pd.Series([default] * len(df), dtype=object).to_numpy()
+    return df[col].fillna("").astype(str).str.strip().to_numpy()
+
 def page_import():
     st.subheader("Importação (CSV simples)")
     if not can("page.import"):
@@ -1051,27 +1356,39 @@ def page_import():
     mode = st.selectbox("Importar como", ["Ingredientes", "Clientes", "Produtos"])
     if st.button("Importar"):
         with SessionLocal() as s:
+            # 1 SELECT para achar os já existentes + 1 INSERT em lote para o resto
+            names = _csv_column(df, "name", "Nome")
             if mode == "Ingredientes":
-                for _, r in df.iterrows():
-                    name = str(r.get("name") or r.get("Nome") or "").strip()
-                    unit = str(r.get("unit") or r.get("Unidade") or "g").strip()
-                    if name and not s.query(Ingredient).filter(Ingredient.name == name).first():
-                        s.add(Ingredient(name=name, unit=unit, is_active=True))
+                units = _csv_column(df, "unit", "Unidade", default="g")
+                units[units == ""] = "g"
+                payload: Dict[str, Dict] = {}
+                for name, unit in zip(names, units):
+                    if name and name not in payload:
+                        payload[name] = {"name": name, "unit": unit, "is_active": True}
+                existing = {n for (n,) in s.query(Ingredient.name).filter(Ingredient.name.in_(payload.keys())).all()}
+                s.bulk_insert_mappings(Ingredient, [v for n, v in payload.items() if n not in existing])
                 s.commit()
+                bump_cache_version("ingredients")
             elif mode == "Clientes":
-                for _, r in df.iterrows():
-                    name = str(r.get("name") or r.get("Nome") or "").strip()
-                    phone = str(r.get("phone") or r.get("Telefone") or "")
-                    address = str(r.get("address") or r.get("Endereço") or "")
-                    if name and not s.query(Client).filter(Client.name == name).first():
-                        s.add(Client(name=name, phone=phone, address=address, is_active=True))
+                phones = _csv_column(df, "phone", "Telefone")
+                addresses = _csv_column(df, "address", "Endereço")
+                payload = {}
+                for name, phone, address in zip(names, phones, addresses):
+                    if name and name not in payload:
+                        payload[name] = {"name": name, "phone": phone, "address": address, "is_active": True}
+                existing = {n for (n,) in s.query(Client.name).filter(Client.name.in_(payload.keys())).all()}
+                s.bulk_insert_mappings(Client, [v for n, v in payload.items() if n not in existing])
                 s.commit()
+                bump_cache_version("clients")
             else:  # Produtos
-                for _, r in df.iterrows():
-                    name = str(r.get("name") or r.get("Nome") or "").strip()
-                    if name and not s.query(Product).filter(Product.name == name).first():
-                        s.add(Product(name=name, is_active=True))
+                payload = {}
+                for name in names:
+                    if name and name not in payload:
+                        payload[name] = {"name": name, "is_active": True}
+                existing = {n for (n,) in s.query(Product.name).filter(Product.name.in_(payload.keys())).all()}
+                s.bulk_insert_mappings(Product, [v for n, v in payload.items() if n not in existing])
                 s.commit()
+                bump_cache_version("products")
         toast_ok("Importação concluída.")
 
 def page_discard():
@@ -1093,16 +1410,18 @@ def page_discard():
                 toast_err("Sem permissão.")
             else:
                 from db import consume_fifo
-                consumed, _ = consume_fifo(s, ing[0], qty, ing[2], order_id=None, note=f"DESCARTE: {reason}")
+                consumed, _ = consume_fifo(s, ing[0], qty, ing[2], order_id=None, note=f"DESCARTE: {reason}", commit=False)
                 s.add(LossEvent(ingredient_id=ing[0], lot_id=None, qty=consumed, reason=reason))
                 s.commit()
                 toast_ok(f"Descartado {consumed} {ing[2]}.")
 
         st.markdown("### Perdas registradas (recentes)")
-        losses = s.query(LossEvent).order_by(LossEvent.created_at.desc()).limit(200).all()
-        rows = [{"Ingrediente": (s.get(Ingredient, l.ingredient_id).name if l.ingredient_id else "?"),
-                 "Qtd": l.qty, "Motivo": l.reason, "Quando": l.created_at} for l in losses]
-        st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+        losses = s.query(Ingredient.name, LossEvent.qty, LossEvent.reason, LossEvent.created_at)\
+            .select_from(LossEvent).outerjoin(Ingredient, Ingredient.id == LossEvent.ingredient_id)\
+            .order_by(LossEvent.created_at.desc()).limit(200).all()
+        df_losses = pd.DataFrame.from_records(losses, columns=["Ingrediente", "Qtd", "Motivo", "Quando"])
+        df_losses["Ingrediente"] = df_losses["Ingrediente"].fillna("?")
+        st.dataframe(df_losses, hide_index=True, use_container_width=True)
 
 def page_settings():
     st.subheader("Configurações")
@@ -1117,6 +1436,8 @@ def page_settings():
             msg_ready = st.text_area("Mensagem de Pedido Pronto (placeholders: {order_id}, {cliente}, {entrega}, {itens}, {obs})", value=cfg.msg_pronto or "")
             stages_txt = st.text_area("Kanban (JSON array de estágios)", value=cfg.kanban_stages_json or json.dumps(DEFAULT_KANBAN_STAGES))
             fifo_stage = st.text_input("Estágio que consome FIFO", value=cfg.fifo_stage or "EM_PRODUCAO")
+            bcrypt_rounds = st.number_input("Custo do bcrypt (rounds)", min_value=10, max_value=15, step=1, value=int(cfg.bcrypt_rounds or 11))
+            st.caption("Rounds maiores deixam as senhas mais resistentes a força bruta, mas cada login/criação de senha fica ~2x mais lento por round.")
             ok = st.form_submit_button("Salvar")
             if ok:
                 if not can("settings.update"):
@@ -1133,10 +1454,22 @@ def page_settings():
                     cfg.msg_pronto = msg_ready
                     cfg.kanban_stages_json = json.dumps(arr)
                     cfg.fifo_stage = fifo_stage or "EM_PRODUCAO"
+                    cfg.bcrypt_rounds = int(bcrypt_rounds)
                     s.commit()
+                    bump_cache_version("config")
                     toast_ok("Configurações salvas.")
                     st.rerun()
 
+# Papéis do usuário selecionado (ids + texto), por versão de RBAC: atribuir/remover
+# passa por on_rbac_changed(), que incrementa a versão e invalida a entrada.
+@st.cache_data(show_spinner=False, max_entries=64)
+def _user_roles_cached(user_id: int, rbac_ver: int) -> Tuple[frozenset, str]:
+    with SessionLocal() as s:
+        rows = s.query(Role.id, Role.name)\
+            .join(user_role_table, user_role_table.c.role_id == Role.id)\
+            .filter(user_role_table.c.user_id == user_id).order_by(Role.name.asc()).all()
+    return frozenset(rid for rid, _ in rows), ", ".join(name for _, name in rows)
+
 def page_users():
     st.subheader("Usuários & Acessos")
     if not can("page.users"):
@@ -1157,18 +1490,19 @@ def page_users():
                     toast_err("Sem permissão.")
                 elif not username or not pwd:
                     toast_err("Preencha usuário e senha.")
-                elif s.query(User).filter(User.username == username).first():
+                elif s.execute(select(User.id).where(User.username == username)).first():
                     toast_err("Usuário já existe.")
                 else:
-                    phash = bcrypt.hashpw(pwd.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+                    phash = hash_password(pwd)
                     u = User(username=username, name=name, email=email, password_hash=phash, is_active=True)
                     s.add(u); s.commit()
+                    bump_cache_version("users")
                     toast_ok("Usuário criado.")
                     st.rerun()
 
         # --- Papéis e permissões ---
         st.markdown("### Papéis e permissões")
-        roles = s.query(Role).order_by(Role.name.asc()).all()
+        role_opts = cached_roles()
         colL, colR = st.columns(2)
 
         with colL:
@@ -1181,16 +1515,16 @@ def page_users():
                         toast_err("Sem permissão.")
                     elif not rname:
                         toast_err("Informe o nome.")
-                    elif s.query(Role).filter(Role.name == rname).first():
+                    elif s.execute(select(Role.id).where(Role.name == rname)).first():
                         toast_err("Já existe.")
                     else:
                         s.add(Role(name=rname, permissions_json=json.dumps([]))); s.commit()
+                        bump_cache_version("roles")
                         toast_ok("Papel criado.")
                         st.rerun()
 
         with colR:
             st.markdown("#### Editar permissões do papel")
-            role_opts = [(r.id, r.name) for r in roles]
             role_choice = st.selectbox(
                 "Papel",
                 role_opts,
@@ -1200,17 +1534,14 @@ def page_users():
             if role_choice:
                 role_id = int(role_choice[0])
                 # recarrega com a sessão atual
-                role_sel = s.get(Role, role_id)
+                # só a coluna necessária; o Role não é hidratado
+                perms_json = s.execute(select(Role.permissions_json).where(Role.id == role_id)).scalar()
                 try:
-                    curr = set(json.loads(role_sel.permissions_json or "[]"))
+                    curr = set(json.loads(perms_json or "[]"))
                 except Exception:
                     curr = set()
 
-                groups: Dict[str, List[str]] = {}
-                for p in sorted(ALL_PERMISSIONS):
-                    groups.setdefault(p.split(".")[0], []).append(p)
-
-                for g, items in groups.items():
+                for g, items in PERMISSION_GROUPS.items():
                     st.markdown(f"**{g.upper()}**")
                     cols = st.columns(3)
                     for i, perm in enumerate(items):
@@ -1230,13 +1561,16 @@ def page_users():
                     if not can("rbac.manage_roles"):
                         toast_err("Sem permissão.")
                     else:
-                        role_sel.permissions_json = json.dumps(sorted(list(curr)))
+                        s.execute(update(Role).where(Role.id == role_id).values(
+                            permissions_json=json.dumps(sorted(list(curr)))
+                        ))
                         s.commit()
+                        on_rbac_changed(s)
                         toast_ok("Permissões salvas.")
 
         # --- Atribuir/Remover papéis ---
         st.markdown("### Atribuir/Remover papéis")
-        user_opts = [(u.id, u.username) for u in s.query(User).order_by(User.username.asc()).all()]
+        user_opts = cached_users()
         u_choice = st.selectbox(
             "Usuário",
             user_opts,
@@ -1245,45 +1579,72 @@ def page_users():
         )
         if u_choice:
             u_id = int(u_choice[0])
-            # recarrega o usuário com as roles já carregadas
-            u_sel = (
-                s.query(User)
-                .options(joinedload(User.roles))
-                .filter(User.id == u_id)
-                .first()
-            )
-            st.write("Papéis atuais:", ", ".join([r.name for r in u_sel.roles]) or "—")
-
-            role_opts2 = [(r.id, r.name) for r in s.query(Role).order_by(Role.name.asc()).all()]
-            r_choice = st.selectbox(
-                "Papel para atribuir/remover",
-                role_opts2,
-                format_func=lambda t: t[1],
-                key="role_assign_select",
-            )
-            if r_choice:
-                r_id = int(r_choice[0])
-                r_sel = s.get(Role, r_id)
-                cols = st.columns(2)
-                if cols[0].button("Atribuir", key="assign_btn"):
-                    if not can("rbac.assign_roles"):
-                        toast_err("Sem permissão.")
-                    elif r_sel not in u_sel.roles:
-                        u_sel.roles.append(r_sel); s.commit(); toast_ok("Papel atribuído.")
-                        if "user" in st.session_state and st.session_state["user"]["id"] == u_sel.id:
-                            st.session_state["perms"] = get_user_permissions(s, u_sel)
-
-                if cols[1].button("Remover", key="remove_btn"):
-                    if not can("rbac.assign_roles"):
-                        toast_err("Sem permissão.")
-                    elif r_sel in u_sel.roles:
-                        u_sel.roles.remove(r_sel); s.commit(); toast_ok("Papel removido.")
-                        if "user" in st.session_state and st.session_state["user"]["id"] == u_sel.id:
-                            st.session_state["perms"] = get_user_permissions(s, u_sel)
+            role_ids, roles_txt = _user_roles_cached(u_id, _perms_version()["v"])
+            st.write("Papéis atuais:", roles_txt or "—")
+
+            # form: marcar/desmarcar papéis não reexecuta a página; "Salvar" aplica tudo
+            # numa transação só (um INSERT multi-linhas + um DELETE, um commit)
+            role_name = dict(role_opts)
+            with st.form(f"role_assign_{u_id}"):
+                chosen = st.multiselect(
+                    "Papéis do usuário",
+                    [rid for rid, _ in role_opts],
+                    default=[rid for rid, _ in role_opts if rid in role_ids],
+                    format_func=lambda rid: role_name.get(rid, "?"),
+                    key=f"role_assign_select_{u_id}",
+                )
+                # sem permissão o botão fica desabilitado (disabled também vale no servidor)
+                do_save = st.form_submit_button("Salvar papéis", disabled=not can("rbac.assign_roles"))
+            if do_save:
+                # o botão desabilitado não basta: nem toda versão do Streamlit barra o clique no servidor
+                if not can("rbac.assign_roles"):
+                    toast_err("Sem permissão.")
+                    st.stop()
+                to_add = set(chosen) - role_ids
+                to_remove = role_ids - set(chosen)
+                if to_add or to_remove:
+                    try:
+                        if to_add:
+                            s.execute(insert(user_role_table), [{"user_id": u_id, "role_id": rid} for rid in to_add])
+                        if to_remove:
+                            s.execute(user_role_table.delete().where(
+                                user_role_table.c.user_id == u_id, user_role_table.c.role_id.in_(to_remove)
+                            ))
+                        sync_admin_flag(s, u_id)
+                        s.commit()
+                    except IntegrityError:
+                        s.rollback()  # alterado em paralelo por outra sessão
+                        toast_err("Papéis alterados por outra sessão; revise e salve de novo.")
+                    else:
+                        toast_ok("Papéis atualizados.")
+                    on_rbac_changed(s)
+                    st.rerun()
 
 # -----------------------
 # Router
 # -----------------------
+# Rótulo -> página; mesmos rótulos (e ordem) de PAGE_PERMISSION, usado por allowed_pages().
+PAGES = {
+    "Dashboard": page_dashboard,
+    "Ingredientes": page_ingredients,
+    "Receitas": page_recipes,
+    "Produtos": page_products,
+    "Clientes": page_clients,
+    "Pedidos – Novo": page_order_new,
+    "Pedidos – Kanban": page_kanban,
+    "Pós-venda": page_postsale,
+    "Calendário": page_calendar,
+    "Compras & Estoque": page_stock,
+    "Importação": page_import,
+    "Descarte & Vencidos": page_discard,
+    "Configurações": page_settings,
+    "Usuários & Acessos": page_users,
+}
+assert PAGES.keys() == PAGE_PERMISSION.keys()
+
+def _page_unavailable():
+    st.info("Página indisponível para seu perfil.")
+
 def run_router():
     app_header()
     if not users_exist():
@@ -1294,38 +1655,16 @@ def run_router():
     if "user" not in st.session_state:
         st.info("Faça login para continuar.")
         return
+    ensure_fresh_perms()
     pages = allowed_pages()
     choice = st.sidebar.selectbox("Páginas", options=pages or ["Dashboard"])
-    if choice == "Dashboard":
-        page_dashboard()
-    elif choice == "Ingredientes":
-        page_ingredients()
-    elif choice == "Receitas":
-        page_recipes()
-    elif choice == "Produtos":
-        page_products()
-    elif choice == "Clientes":
-        page_clients()
-    elif choice == "Pedidos – Novo":
-        page_order_new()
-    elif choice == "Pedidos – Kanban":
-        page_kanban()
-    elif choice == "Pós-venda":
-        page_postsale()
-    elif choice == "Calendário":
-        page_calendar()
-    elif choice == "Compras & Estoque":
-        page_stock()
-    elif choice == "Importação":
-        page_import()
-    elif choice == "Descarte & Vencidos":
-        page_discard()
-    elif choice == "Configurações":
-        page_settings()
-    elif choice == "Usuários & Acessos":
-        page_users()
+    if _DEBUG_RAISELOAD:
+        # em dev: mostra quantas consultas a página fez (regressões de N+1 ficam visíveis)
+        with count_queries(engine) as qc:
+            PAGES.get(choice, _page_unavailable)()
+        st.sidebar.caption(f"SQL nesta execução: {qc['n']}")
     else:
-        st.info("Página indisponível para seu perfil.")
+        PAGES.get(choice, _page_unavailable)()
 
 if __name__ == "__main__":
     run_router()
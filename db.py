@@ -4,14 +4,16 @@
 from __future__ import annotations
 import json
 import os
+import functools
+from contextlib import contextmanager
 import datetime as dt
-from typing import Dict, List, Optional, Tuple, Union, Set
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Union, Set
 
 from sqlalchemy import (
     create_engine, Column, Integer, String, Float, Boolean, DateTime, ForeignKey,
-    Text, Date, Table, text, inspect
+    Text, Date, Table, Index, text, inspect, func, and_, event, select, insert, update, bindparam
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, Session, selectinload, deferred
 
 # ---------------------------------------------------------------------
 # Base / Constantes
@@ -34,23 +36,71 @@ def make_engine(database_url: Optional[str] = None):
             url = url + "&sslmode=require"
         else:
             url = url + "?sslmode=require"
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]  # esquema antigo (Heroku/Neon) não é aceito pelo SQLAlchemy
+    if url.startswith("postgres"):
+        connect_args = {"options": "-c statement_timeout=" + os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000")}
+        if url.startswith("postgresql+psycopg://"):
+            # psycopg 3 prepara no servidor statements repetidos (token, FIFO) após N execuções
+            connect_args["prepare_threshold"] = int(os.getenv("DB_PREPARE_THRESHOLD", "5"))
+        kw["connect_args"] = connect_args
+        # pool reaproveitado entre reruns (engine fica em cache_resource no app);
+        # recycle antes do timeout de ociosidade do provedor evita conexões mortas no pre_ping
+        kw.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "300")),
+            # pool esgotado: erro em segundos em vez de travar a página por 30 s
+            pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "10")),
+        )
     engine = create_engine(url, **kw)
     if url.startswith("sqlite"):
         @event.listens_for(engine, "connect")
         def _set_sqlite_pragma(dbapi_connection, connection_record):
             cursor = dbapi_connection.cursor()
             cursor.execute("PRAGMA foreign_keys=ON")
+            # WAL: leitores não esperam escritores; NORMAL só faz fsync no checkpoint (seguro com WAL)
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            cursor.execute("PRAGMA cache_size=-65536")      # 64 MB
+            cursor.execute("PRAGMA mmap_size=268435456")    # 256 MB
+            cursor.execute("PRAGMA busy_timeout=5000")
             cursor.close()
+
+        @event.listens_for(engine.pool, "close")
+        def _optimize_sqlite(dbapi_connection, connection_record):
+            # estatísticas do planejador atualizadas ao fechar a conexão (recomendação do SQLite)
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute("PRAGMA analysis_limit=400")
+                cursor.execute("PRAGMA optimize")
+                cursor.close()
+            except Exception:
+                pass
     return engine
 
 
 def make_sessionmaker(engine):
     return sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
 
+@contextmanager
+def count_queries(engine):
+    """Conta os statements SQL executados no bloco: {"n": total}. Diagnóstico de N+1 em dev
+    (o listener é do engine, então execuções concorrentes de outras sessões também contam)."""
+    counter = {"n": 0}
+    def _count(conn, cursor, statement, parameters, context, executemany):
+        counter["n"] += 1
+    event.listen(engine, "before_cursor_execute", _count)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", _count)
+
 # ---------------------------------------------------------------------
 # RBAC
 # ---------------------------------------------------------------------
-ALL_PERMISSIONS: Set[str] = set([
+ALL_PERMISSIONS: FrozenSet[str] = frozenset([
     # páginas
     "page.dashboard","page.ingredients","page.recipes","page.products","page.clients",
     "page.orders.new","page.orders.kanban","page.postsale","page.calendar",
@@ -76,6 +126,30 @@ ALL_PERMISSIONS: Set[str] = set([
     "rbac.manage_users","rbac.manage_roles","rbac.assign_roles",
 ])
 
+# Papéis padrão (seed_default_roles); JSON canônico serializado uma vez no import
+STAFF_PERMISSIONS: FrozenSet[str] = frozenset([
+    "page.dashboard","page.ingredients","page.recipes","page.products",
+    "page.clients","page.orders.new","page.orders.kanban","page.postsale","page.calendar",
+    "page.stock","page.discard",
+    "ingredient.create","ingredient.update","ingredient.buy_lot",
+    "recipe.create","recipe.update",
+    "product.create","product.update",
+    "client.create","client.update",
+    "order.create","order.update","order.mark_paid","order.unmark_paid",
+    "order.move_stage","order.consume_fifo","order.cancel",
+    "stock.discard","stock.discard_expired",
+])
+
+SELLER_PERMISSIONS: FrozenSet[str] = frozenset([
+    "page.dashboard","page.products","page.clients","page.orders.new","page.orders.kanban","page.calendar",
+    "client.create","client.update",
+    "order.create","order.update","order.mark_paid","order.unmark_paid","order.move_stage","order.cancel",
+])
+
+_ALL_PERMISSIONS_JSON = json.dumps(sorted(ALL_PERMISSIONS))
+_STAFF_PERMISSIONS_JSON = json.dumps(sorted(STAFF_PERMISSIONS))
+_SELLER_PERMISSIONS_JSON = json.dumps(sorted(SELLER_PERMISSIONS))
+
 # ---------------------------------------------------------------------
 # Modelos
 # ---------------------------------------------------------------------
@@ -87,6 +161,13 @@ class Config(Base):
     msg_pronto = Column(Text, default="Pedido {order_id} do cliente {cliente} está pronto para {entrega}. Itens: {itens}. Obs: {obs}")
     kanban_stages_json = Column(Text, default=lambda: json.dumps(DEFAULT_KANBAN_STAGES))
     fifo_stage = Column(String(64), default="EM_PRODUCAO")  # estágio que dispara o consumo FIFO
+    bcrypt_rounds = Column(Integer, default=11)  # custo do bcrypt (segurança x CPU por login)
+    created_at = Column(DateTime, default=dt.datetime.utcnow)
+
+class SeedMarker(Base):
+    """Seeds de demonstração já aplicadas (seed_basic.py): uma linha por tag."""
+    __tablename__ = "seed_marker"
+    tag = Column(String(50), primary_key=True)
     created_at = Column(DateTime, default=dt.datetime.utcnow)
 
 # associação usuário <-> papel
@@ -101,7 +182,7 @@ class Role(Base):
     __tablename__ = "role"
     id = Column(Integer, primary_key=True)
     name = Column(String(50), unique=True, nullable=False)
-    permissions_json = Column(Text, default=lambda: json.dumps(sorted(list(ALL_PERMISSIONS))))
+    permissions_json = Column(Text, default=_ALL_PERMISSIONS_JSON)
     users = relationship("User", secondary=user_role_table, back_populates="roles")
 
 class User(Base):
@@ -110,8 +191,10 @@ class User(Base):
     username = Column(String(50), unique=True, nullable=False, index=True)
     name = Column(String(120))
     email = Column(String(200))
-    password_hash = Column(String(200), nullable=False)
+    password_hash = deferred(Column(String(200), nullable=False))  # só o login lê (undefer lá)
     is_active = Column(Boolean, default=True)
+    # espelho de "tem o papel admin" (sync_admin_flag): admin não precisa carregar papéis
+    is_admin = Column(Boolean, default=False)
     created_at = Column(DateTime, default=dt.datetime.utcnow)
     roles = relationship("Role", secondary=user_role_table, back_populates="users")
 
@@ -120,7 +203,10 @@ class LoginToken(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
     token = Column(String(64), unique=True, nullable=False, index=True)
-    created_at = Column(DateTime, default=dt.datetime.utcnow)
+    created_at = Column(DateTime, default=dt.datetime.utcnow, index=True)
+
+# Tokens de login valem até TOKEN_MAX_AGE_DAYS (checado na consulta); os antigos são apagados no init_db
+TOKEN_MAX_AGE = dt.timedelta(days=int(os.getenv("TOKEN_MAX_AGE_DAYS", "30")))
 
 def create_login_token(session: Session, user_id: int) -> str:
     import secrets
@@ -130,13 +216,28 @@ def create_login_token(session: Session, user_id: int) -> str:
     return tok
 
 def get_user_by_token(session: Session, token: str) -> Optional[User]:
-    lt = session.query(LoginToken).filter(LoginToken.token == token).first()
-    return session.get(User, lt.user_id) if lt else None
+    # token e usuário numa consulta só (JOIN); roles vêm junto porque quem resolve o token
+    # normalmente calcula permissões em seguida
+    cutoff = dt.datetime.utcnow() - TOKEN_MAX_AGE  # token vencido não autentica, mesmo antes da limpeza
+    return session.execute(_TOKEN_USER_SELECT, {"t": token, "cutoff": cutoff}).scalars().first()
+
+# statements montados uma vez (LoginToken nunca é hidratado)
+_TOKEN_USER_SELECT = select(User).join(LoginToken, LoginToken.user_id == User.id)\
+    .where(LoginToken.token == bindparam("t"), LoginToken.created_at >= bindparam("cutoff"))\
+    .options(selectinload(User.roles))
+_DELETE_TOKEN_STMT = LoginToken.__table__.delete().where(LoginToken.__table__.c.token == bindparam("t"))
+_DELETE_OLD_TOKENS_STMT = LoginToken.__table__.delete().where(LoginToken.__table__.c.created_at < bindparam("cutoff"))
 
 def delete_token(session: Session, token: str):
-    session.query(LoginToken).filter(LoginToken.token == token).delete()
+    session.execute(_DELETE_TOKEN_STMT, {"t": token})
     session.commit()
 
+def cleanup_expired_tokens(session: Session, older_than: dt.timedelta = TOKEN_MAX_AGE) -> int:
+    """Apaga tokens criados antes de agora - older_than num único DELETE. Retorna quantos."""
+    res = session.execute(_DELETE_OLD_TOKENS_STMT, {"cutoff": dt.datetime.utcnow() - older_than})
+    session.commit()
+    return res.rowcount or 0
+
 class Supplier(Base):
     __tablename__ = "supplier"
     id = Column(Integer, primary_key=True)
@@ -147,6 +248,9 @@ class Supplier(Base):
 
 class Ingredient(Base):
     __tablename__ = "ingredient"
+    __table_args__ = (
+        Index("ix_ingredient_active_name", "is_active", "name"),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String(120), unique=True, nullable=False)
     unit = Column(String(10), default="g")
@@ -167,6 +271,12 @@ class IngredientPrice(Base):
 
 class StockLot(Base):
     __tablename__ = "stock_lot"
+    __table_args__ = (
+        Index("ix_stocklot_ing_qty", "ingredient_id", "qty_remaining"),
+        # mesma ordem do consume_fifo; parcial: lotes zerados não entram no índice
+        Index("ix_stock_lot_fifo", "ingredient_id", "best_before", "created_at",
+              postgresql_where=text("qty_remaining > 0"), sqlite_where=text("qty_remaining > 0")),
+    )
     id = Column(Integer, primary_key=True)
     ingredient_id = Column(Integer, ForeignKey("ingredient.id", ondelete="CASCADE"), nullable=False)
     qty_total = Column(Float, nullable=False)        # quantidade comprada
@@ -199,7 +309,7 @@ class Recipe(Base):
 class RecipeItem(Base):
     __tablename__ = "recipe_item"
     id = Column(Integer, primary_key=True)
-    recipe_id = Column(Integer, ForeignKey("recipe.id", ondelete="CASCADE"), nullable=False)
+    recipe_id = Column(Integer, ForeignKey("recipe.id", ondelete="CASCADE"), nullable=False, index=True)
     ingredient_id = Column(Integer, ForeignKey("ingredient.id", ondelete="SET NULL"))
     sub_recipe_id = Column(Integer, ForeignKey("recipe.id", ondelete="SET NULL"))
     qty = Column(Float, nullable=False)
@@ -227,7 +337,7 @@ class Client(Base):
     name = Column(String(120), nullable=False, index=True)
     phone = Column(String(50))
     address = Column(String(200))
-    notes = Column(Text)
+    notes = deferred(Column(Text))  # só o editor de clientes lê
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=dt.datetime.utcnow)
 
@@ -235,11 +345,16 @@ class Client(Base):
 
 class Order(Base):
     __tablename__ = "order"
+    __table_args__ = (
+        # colunas do Kanban (status) e do pós-venda (pos_stage), já na ordem dos cards
+        Index("ix_order_status_delivery", "status", "delivery_date", "created_at"),
+        Index("ix_order_pos_stage_delivery", "pos_stage", "delivery_date"),
+    )
     id = Column(Integer, primary_key=True)
     client_id = Column(Integer, ForeignKey("client.id", ondelete="SET NULL"))
     status = Column(String(64), default="NOVO", index=True)
     paid = Column(Boolean, default=False)
-    delivery_date = Column(Date)
+    delivery_date = Column(Date, index=True)
     total = Column(Float, default=0.0)
     obs = Column(Text)
     pos_stage = Column(String(32), default="ENTREGUE")
@@ -247,7 +362,7 @@ class Order(Base):
     pos1_date = Column(Date)
     pos2_date = Column(Date)
     # <<<
-    canceled_reason = Column(Text)
+    canceled_reason = deferred(Column(Text))  # gravado no cancelamento, não exibido nos cards
     created_at = Column(DateTime, default=dt.datetime.utcnow)
     client = relationship("Client")
     items = relationship("OrderItem", back_populates="order", cascade="all, delete")
@@ -257,7 +372,7 @@ class Order(Base):
 class OrderItem(Base):
     __tablename__ = "order_item"
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey("order.id", ondelete="CASCADE"), nullable=False)
+    order_id = Column(Integer, ForeignKey("order.id", ondelete="CASCADE"), nullable=False, index=True)
     product_id = Column(Integer, ForeignKey("product.id", ondelete="SET NULL"))
     qty = Column(Float, nullable=False)
     unit_price = Column(Float, nullable=False)
@@ -272,11 +387,11 @@ class StockMove(Base):
     id = Column(Integer, primary_key=True)
     lot_id = Column(Integer, ForeignKey("stock_lot.id", ondelete="SET NULL"))
     ingredient_id = Column(Integer, ForeignKey("ingredient.id", ondelete="SET NULL"))
-    move_type = Column(String(12), default="OUT")    # IN, OUT, ADJUST, LOSS
+    move_type = Column(String(12), default="OUT", index=True)    # IN, OUT, ADJUST, LOSS
     qty = Column(Float, nullable=False)
     unit = Column(String(20), default="g")
     cost = Column(Float, default=0.0)                # custo (para OUT/LOSS)
-    order_id = Column(Integer, ForeignKey("order.id", ondelete="SET NULL"))
+    order_id = Column(Integer, ForeignKey("order.id", ondelete="SET NULL"), index=True)
     notes = Column(Text)
     created_at = Column(DateTime, default=dt.datetime.utcnow)
 
@@ -328,83 +443,97 @@ class ManualPurchaseItem(Base):
 # RBAC helpers
 # ---------------------------------------------------------------------
 def seed_default_roles(session: Session):
-    """Cria papéis admin, staff e seller idempotentemente."""
-    existing = {r.name: r for r in session.query(Role).all()}
-
-    if "admin" not in existing:
-        admin = Role(name="admin", permissions_json=json.dumps(sorted(list(ALL_PERMISSIONS))))
-        session.add(admin)
-
-    staff_perms = {
-        "page.dashboard","page.ingredients","page.recipes","page.products",
-        "page.clients","page.orders.new","page.orders.kanban","page.postsale","page.calendar",
-        "page.stock","page.discard",
-        "ingredient.create","ingredient.update","ingredient.buy_lot",
-        "recipe.create","recipe.update",
-        "product.create","product.update",
-        "client.create","client.update",
-        "order.create","order.update","order.mark_paid","order.unmark_paid",
-        "order.move_stage","order.consume_fifo","order.cancel",
-        "stock.discard","stock.discard_expired",
-    }
-    if "staff" not in existing:
-        staff = Role(name="staff", permissions_json=json.dumps(sorted(list(staff_perms))))
-        session.add(staff)
-
-    seller_perms = {
-        "page.dashboard","page.products","page.clients","page.orders.new","page.orders.kanban","page.calendar",
-        "client.create","client.update",
-        "order.create","order.update","order.mark_paid","order.unmark_paid","order.move_stage","order.cancel",
-    }
-    if "seller" not in existing:
-        seller = Role(name="seller", permissions_json=json.dumps(sorted(list(seller_perms))))
-        session.add(seller)
-
+    """Cria papéis admin, staff e seller idempotentemente (INSERT ... ON CONFLICT DO NOTHING)."""
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as upsert_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as upsert_insert
+    else:
+        upsert_insert = None
+    defaults = [
+        ("admin", _ALL_PERMISSIONS_JSON),
+        ("staff", _STAFF_PERMISSIONS_JSON),
+        ("seller", _SELLER_PERMISSIONS_JSON),
+    ]
+    if upsert_insert is not None:
+        # um único INSERT multi-linha (VALUES (...), (...), (...)), não um executemany
+        session.execute(
+            upsert_insert(Role.__table__)
+            .values([{"name": name, "permissions_json": perms_json} for name, perms_json in defaults])
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+    else:
+        existing = {name for (name,) in session.query(Role.name).filter(Role.name.in_([n for n, _ in defaults]))}
+        for name, perms_json in defaults:
+            if name not in existing:
+                session.add(Role(name=name, permissions_json=perms_json))
     session.commit()
 
 def _normalize_user_ref(session: Session, user_ref: Union[int, str, User]) -> Optional[User]:
     if isinstance(user_ref, User):
         return user_ref
     if isinstance(user_ref, int):
-        return session.get(User, user_ref)
+        return session.get(User, user_ref, options=[selectinload(User.roles)])
     if isinstance(user_ref, str):
-        return session.query(User).filter(User.username == user_ref).first()
+        return session.query(User).options(selectinload(User.roles))\
+            .filter(User.username == user_ref).first()
     return None
 
-def get_user_permissions(session: Session, user_ref: Union[int, str, User]) -> Set[str]:
+@functools.lru_cache(maxsize=256)
+def _decode_perms(raw: str) -> frozenset:
+    """permissions_json -> frozenset; o texto é a chave, então editar o papel já invalida."""
+    try:
+        return frozenset(json.loads(raw))
+    except Exception:
+        return frozenset()
+
+def sync_admin_flag(session: Session, user_id: int):
+    """Recalcula User.is_admin após mudar os papéis do usuário (o chamador faz o commit)."""
+    has_admin = select(user_role_table.c.user_id)\
+        .join(Role, Role.id == user_role_table.c.role_id)\
+        .where(user_role_table.c.user_id == user_id, Role.name == "admin").exists()
+    session.execute(update(User).where(User.id == user_id).values(is_admin=has_admin))
+
+def get_user_permissions(session: Session, user_ref: Union[int, str, User]) -> FrozenSet[str]:
     """Aceita id, username ou objeto User. Admin recebe TODAS as permissões."""
     user = _normalize_user_ref(session, user_ref)
     if not user or not user.is_active:
-        return set()
+        return frozenset()
+    if user.is_admin:
+        return ALL_PERMISSIONS  # atalho: nem carrega papéis
+    if "roles" in inspect(user).unloaded:
+        # um único SELECT (nome, permissões) de todos os papéis, sem hidratar objetos Role
+        rows = session.query(Role.name, Role.permissions_json)\
+            .join(user_role_table, user_role_table.c.role_id == Role.id)\
+            .filter(user_role_table.c.user_id == user.id).all()
+    else:
+        rows = [(r.name, r.permissions_json) for r in user.roles]  # pré-carregado via selectinload
+    if any(name == "admin" for name, _ in rows):
+        return ALL_PERMISSIONS  # imutável: sem cópia
     perms: Set[str] = set()
-    for role in user.roles:
-        try:
-            role_perms = set(json.loads(role.permissions_json or "[]"))
-        except Exception:
-            role_perms = set()
-        perms |= role_perms
-    if any(r.name == "admin" for r in user.roles):
-        perms = set(ALL_PERMISSIONS)
-    return perms
+    for _, perms_json in rows:
+        perms |= _decode_perms(perms_json or "[]")
+    return frozenset(perms)
 
 # ---------------------------------------------------------------------
 # Config default
 # ---------------------------------------------------------------------
 def get_or_create_default_config(session: Session) -> Config:
+    """Config única; cria ou corrige campos inválidos com no máximo um commit."""
     cfg = session.query(Config).first()
     if not cfg:
-        cfg = Config()
+        cfg = Config(kanban_stages_json=json.dumps(DEFAULT_KANBAN_STAGES), fifo_stage="EM_PRODUCAO")
         session.add(cfg)
-        session.commit()
     # fallback para JSON inválido ou vazio
     try:
         stages = json.loads(cfg.kanban_stages_json or "[]")
         assert isinstance(stages, list) and len(stages) > 0
     except Exception:
         cfg.kanban_stages_json = json.dumps(DEFAULT_KANBAN_STAGES)
-        session.commit()
     if not cfg.fifo_stage:
         cfg.fifo_stage = "EM_PRODUCAO"
+    if cfg in session.new or session.is_modified(cfg):
         session.commit()
     return cfg
 
@@ -428,28 +557,50 @@ def column_exists(engine, table_name: str, column_name: str) -> bool:
         return False
     return any(c.get("name") == column_name for c in cols)
 
+def _schema_snapshot(engine) -> Dict[str, Set[str]]:
+    """{tabela: {colunas}} lidos numa única passada do inspector."""
+    insp = inspect(engine)
+    tables = insp.get_table_names()
+    if hasattr(insp, "get_multi_columns"):  # SQLAlchemy 2.0: uma consulta para todas as tabelas
+        multi = insp.get_multi_columns()
+        return {t: {c["name"] for c in cols} for (_, t), cols in multi.items() if t in tables}
+    return {t: {c["name"] for c in insp.get_columns(t)} for t in tables}
+
 def run_safe_migrations(engine):
     """Migrações idempotentes para Postgres/SQLite."""
+    schema = _schema_snapshot(engine)  # todas as checagens abaixo leem daqui
     with engine.begin() as conn:
         # ---------- CONFIG ----------
-        if table_exists(engine, "config"):
-            if not column_exists(engine, "config", "kanban_stages_json"):
+        if "config" in schema:
+            if "kanban_stages_json" not in schema.get("config", ()):
                 conn.execute(text('ALTER TABLE "config" ADD COLUMN kanban_stages_json TEXT'))
-            if not column_exists(engine, "config", "fifo_stage"):
+            if "fifo_stage" not in schema.get("config", ()):
                 conn.execute(text('ALTER TABLE "config" ADD COLUMN fifo_stage VARCHAR(64)'))
+            if "bcrypt_rounds" not in schema.get("config", ()):
+                conn.execute(text('ALTER TABLE "config" ADD COLUMN bcrypt_rounds INTEGER DEFAULT 11'))
+
+        # ---------- USER.is_admin (preenchido a partir do papel admin) ----------
+        if "user" in schema and "is_admin" not in schema.get("user", ()):
+            conn.execute(text('ALTER TABLE "user" ADD COLUMN is_admin BOOLEAN DEFAULT FALSE'))
+            conn.execute(text("""
+                UPDATE "user" SET is_admin = EXISTS (
+                    SELECT 1 FROM user_role ur JOIN role r ON r.id = ur.role_id
+                    WHERE ur.user_id = "user".id AND r.name = 'admin'
+                )
+            """))
 
         # ---------- MANUAL_PURCHASE ----------
-        if table_exists(engine, "manual_purchase"):
-            if not column_exists(engine, "manual_purchase", "is_suggestion"):
+        if "manual_purchase" in schema:
+            if "is_suggestion" not in schema.get("manual_purchase", ()):
                 # BOOLEAN DEFAULT FALSE (não 0) para Postgres
                 conn.execute(text('ALTER TABLE "manual_purchase" ADD COLUMN is_suggestion BOOLEAN DEFAULT FALSE'))
-            if not column_exists(engine, "manual_purchase", "title"):
+            if "title" not in schema.get("manual_purchase", ()):
                 conn.execute(text('ALTER TABLE "manual_purchase" ADD COLUMN title VARCHAR(200)'))
-            if not column_exists(engine, "manual_purchase", "completed_at"):
+            if "completed_at" not in schema.get("manual_purchase", ()):
                 conn.execute(text('ALTER TABLE "manual_purchase" ADD COLUMN completed_at TIMESTAMP'))
 
         # ---------- RECIPE / RECIPE_ITEM (garante que existam) ----------
-        if not table_exists(engine, "recipe"):
+        if "recipe" not in schema:
             conn.execute(text("""
                 CREATE TABLE IF NOT EXISTS recipe (
                     id SERIAL PRIMARY KEY,
@@ -460,7 +611,7 @@ def run_safe_migrations(engine):
                     created_at TIMESTAMP
                 )
             """))
-        if not table_exists(engine, "recipe_item"):
+        if "recipe_item" not in schema:
             conn.execute(text("""
                 CREATE TABLE IF NOT EXISTS recipe_item (
                     id SERIAL PRIMARY KEY,
@@ -473,25 +624,160 @@ def run_safe_migrations(engine):
             """))
 
         # ---------- PRODUCT.recipe_id ----------
-        if table_exists(engine, "product"):
-            if not column_exists(engine, "product", "recipe_id"):
+        if "product" in schema:
+            if "recipe_id" not in schema.get("product", ()):
                 conn.execute(text('ALTER TABLE "product" ADD COLUMN recipe_id INTEGER REFERENCES recipe(id) ON DELETE SET NULL'))
 
         # ---------- ORDER.pos_stage + POS1/POS2 ----------
-        if table_exists(engine, "order"):
-            if not column_exists(engine, "order", "pos_stage"):
+        if "order" in schema:
+            if "pos_stage" not in schema.get("order", ()):
                 conn.execute(text("ALTER TABLE \"order\" ADD COLUMN pos_stage VARCHAR(32) DEFAULT 'ENTREGUE'"))
-            if not column_exists(engine, "order", "pos1_date"):
+            if "pos1_date" not in schema.get("order", ()):
                 conn.execute(text('ALTER TABLE "order" ADD COLUMN pos1_date DATE'))
-            if not column_exists(engine, "order", "pos2_date"):
+            if "pos2_date" not in schema.get("order", ()):
                 conn.execute(text('ALTER TABLE "order" ADD COLUMN pos2_date DATE'))
 
+        # ---------- ÍNDICES (bancos criados antes dos índices) ----------
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_order_delivery_date ON "order" (delivery_date)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_stock_move_move_type ON "stock_move" (move_type)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_ingredient_active_name ON "ingredient" (is_active, name)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_order_status_delivery ON "order" (status, delivery_date, created_at)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_order_pos_stage_delivery ON "order" (pos_stage, delivery_date)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_stocklot_ing_qty ON "stock_lot" (ingredient_id, qty_remaining)'))
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_stock_lot_fifo ON "stock_lot" (ingredient_id, best_before, created_at) '
+            'WHERE qty_remaining > 0'
+        ))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_stock_move_order_id ON "stock_move" (order_id)'))
+        # nem SQLite nem Postgres indexam FKs sozinhos: itens por pedido e por receita
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_order_item_order_id ON "order_item" (order_id)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_recipe_item_recipe_id ON "recipe_item" (recipe_id)'))
+        conn.execute(text('CREATE INDEX IF NOT EXISTS ix_login_token_created_at ON "login_token" (created_at)'))
+
+    # ---------- CLIENT.name trigram (só Postgres; exige pg_trgm) ----------
+    if engine.dialect.name == "postgresql":
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text(
+                    'CREATE INDEX IF NOT EXISTS ix_client_name_trgm ON "client" USING gin (name gin_trgm_ops)'
+                ))
+        except Exception:
+            pass  # sem permissão para a extensão: busca continua funcionando, só sem o índice
+
+        # ---------- ORDER.total mantido pelo banco (só Postgres; exige CREATE FUNCTION/TRIGGER) ----------
+        global _order_total_trigger
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("""
+                CREATE OR REPLACE FUNCTION trg_order_total() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP <> 'INSERT' THEN
+                        UPDATE "order" SET total = (
+                            SELECT COALESCE(SUM(qty * unit_price), 0) FROM order_item WHERE order_id = OLD.order_id
+                        ) WHERE id = OLD.order_id;
+                    END IF;
+                    IF TG_OP <> 'DELETE' THEN
+                        UPDATE "order" SET total = (
+                            SELECT COALESCE(SUM(qty * unit_price), 0) FROM order_item WHERE order_id = NEW.order_id
+                        ) WHERE id = NEW.order_id;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+                """))
+                exists = conn.execute(text(
+                    "SELECT 1 FROM pg_trigger WHERE tgname = 'order_item_total' "
+                    "AND tgrelid = '\"order_item\"'::regclass"
+                )).first()
+                if not exists:
+                    conn.execute(text(
+                        'CREATE TRIGGER order_item_total AFTER INSERT OR UPDATE OF qty, unit_price, order_id OR DELETE '
+                        'ON "order_item" FOR EACH ROW EXECUTE PROCEDURE trg_order_total()'
+                    ))
+            _order_total_trigger = True
+        except Exception:
+            pass  # sem permissão: o app recalcula o total explicitamente (recompute_order_total)
+
+
+# ---------------------------------------------------------------------
+# Versão do estoque (invalidação de caches de faltas/custos)
+# ---------------------------------------------------------------------
+_stock_version = 0
+
+def stock_version() -> int:
+    """Contador do processo; muda a cada commit que grava lotes, receitas ou produtos."""
+    return _stock_version
+
+def bump_stock_version():
+    """Invalida agora; gravações em sessão devem usar mark_stock_changed (só vale após o commit)."""
+    global _stock_version
+    _stock_version += 1
+
+def mark_stock_changed(session: Session):
+    """Para gravações via Core (UPDATE/INSERT direto) que não passam pelo flush do ORM:
+    a versão muda só quando o commit der certo (leitores não cacheiam estado não commitado)."""
+    session.info["stock_dirty"] = True
+
+@event.listens_for(Session, "after_flush")
+def _track_stock_changes(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (StockLot, Recipe, RecipeItem, Product)):
+            mark_stock_changed(session)
+            return
+
+@event.listens_for(Session, "after_commit")
+def _bump_stock_on_commit(session):
+    if session.info.pop("stock_dirty", False):
+        bump_stock_version()
+
+@event.listens_for(Session, "after_rollback")
+def _discard_stock_mark(session):
+    session.info.pop("stock_dirty", None)
 
 # ---------------------------------------------------------------------
 # Helpers de Estoque FIFO e custos
 # ---------------------------------------------------------------------
+# consultas quentes montadas uma vez no import; só os parâmetros mudam por chamada
+_FIFO_LOTS_SELECT = select(StockLot.id, StockLot.qty_remaining, StockLot.unit, StockLot.buy_price).where(
+    StockLot.ingredient_id == bindparam("ing_id"),
+    StockLot.qty_remaining > 0
+).order_by(
+    StockLot.best_before.is_(None),
+    StockLot.best_before.asc(),
+    StockLot.created_at.asc()
+).with_for_update()  # trava os lotes no Postgres (ignorado no SQLite)
+
+# mesma ordem FIFO, para vários ingredientes de uma vez (consumo de pedido)
+_FIFO_LOTS_MULTI_SELECT = select(
+    StockLot.ingredient_id, StockLot.id, StockLot.qty_remaining, StockLot.unit, StockLot.buy_price
+).where(
+    StockLot.ingredient_id.in_(bindparam("ids", expanding=True)),
+    StockLot.qty_remaining > 0
+).order_by(
+    StockLot.ingredient_id,
+    StockLot.best_before.is_(None),
+    StockLot.best_before.asc(),
+    StockLot.created_at.asc()
+).with_for_update()
+
+_AVAIL_SUM_SELECT = select(StockLot.ingredient_id, func.sum(StockLot.qty_remaining)).where(
+    StockLot.ingredient_id.in_(bindparam("ids", expanding=True)),
+    StockLot.qty_remaining > 0
+).group_by(StockLot.ingredient_id)
+
+_AVG_COST_SELECT = select(
+    StockLot.ingredient_id,
+    func.sum(StockLot.qty_remaining * StockLot.buy_price),
+    func.sum(StockLot.qty_remaining),
+).where(
+    StockLot.ingredient_id.in_(bindparam("ids", expanding=True)),
+    StockLot.qty_remaining > 0
+).group_by(StockLot.ingredient_id)
+
 def create_lot(session: Session, ingredient_id: int, qty: float, unit: str, unit_price: float,
-               best_before: Optional[dt.date]=None, note: Optional[str]=None) -> StockLot:
+               best_before: Optional[dt.date]=None, note: Optional[str]=None, commit: bool=True) -> StockLot:
+    """commit=False deixa a transação aberta para quem cria vários lotes de uma vez."""
     lot = StockLot(
         ingredient_id=ingredient_id,
         qty_total=qty,
@@ -507,58 +793,101 @@ def create_lot(session: Session, ingredient_id: int, qty: float, unit: str, unit
         lot_id=lot.id, ingredient_id=ingredient_id, move_type="IN",
         qty=qty, unit=unit, cost=qty*unit_price, notes="Compra/Lote"
     ))
-    session.commit()
+    if commit:
+        session.commit()
     return lot
 
+def bulk_create_lots(session: Session, lots: Iterable[Dict], chunksize: int = 1000,
+                     commit: bool = True) -> List[int]:
+    """Cria vários lotes de uma vez; cada item: {ingredient_id, qty, unit, unit_price, best_before?, note?}.
+    Por bloco: um flush dos lotes e um INSERT multi-linha dos StockMove (IN). Retorna os ids.
+    commit=True faz um commit por bloco; commit=False deixa a transação para o chamador."""
+    ids: List[int] = []
+    batch: List[Dict] = []
+
+    def _write(batch: List[Dict]):
+        objs = [StockLot(
+            ingredient_id=d["ingredient_id"], qty_total=d["qty"], qty_remaining=d["qty"], unit=d["unit"],
+            buy_price=d["unit_price"], best_before=d.get("best_before"), note=d.get("note"),
+        ) for d in batch]
+        session.add_all(objs)
+        session.flush()  # ids dos lotes para os movimentos
+        session.execute(insert(StockMove), [dict(
+            lot_id=lot.id, ingredient_id=lot.ingredient_id, move_type="IN",
+            qty=lot.qty_total, unit=lot.unit, cost=lot.qty_total*lot.buy_price, notes="Compra/Lote",
+        ) for lot in objs])
+        ids.extend(lot.id for lot in objs)
+        if commit:
+            session.commit()
+
+    for d in lots:
+        batch.append(d)
+        if len(batch) >= chunksize:
+            _write(batch)
+            batch = []
+    if batch:
+        _write(batch)
+    return ids
+
 def average_cost(session: Session, ingredient_id: int) -> float:
     """Custo médio ponderado pelos lotes restantes; se vazio, usa último preço cadastrado."""
-    lots = session.query(StockLot).filter(
-        StockLot.ingredient_id == ingredient_id,
-        StockLot.qty_remaining > 0
-    ).all()
-    if lots:
-        tot_qty = sum(l.qty_remaining for l in lots)
-        tot_val = sum(l.qty_remaining * l.buy_price for l in lots)
-        if tot_qty > 0:
-            return tot_val / tot_qty
-    p = session.query(IngredientPrice).filter(
-        IngredientPrice.ingredient_id==ingredient_id
-    ).order_by(IngredientPrice.created_at.desc()).first()
-    return p.price if p else 0.0
-
-def _consume_from_lot(session: Session, lot: StockLot, qty: float, order_id: Optional[int], note: str="Consumo FIFO") -> float:
-    taken = min(qty, lot.qty_remaining)
-    if taken <= 0:
-        return 0.0
-    lot.qty_remaining -= taken
-    session.add(StockMove(
-        lot_id=lot.id, ingredient_id=lot.ingredient_id, move_type="OUT",
-        qty=taken, unit=lot.unit, cost=taken*lot.buy_price, order_id=order_id, notes=note
-    ))
-    return taken
+    # agregado no banco (SUM/GROUP BY), sem hidratar StockLot
+    return average_costs(session, [ingredient_id])[ingredient_id]
 
 def consume_fifo(session: Session, ingredient_id: int, qty_needed: float, unit: str,
-                 order_id: Optional[int]=None, note:str="Consumo FIFO") -> Tuple[float, float]:
-    """Consome por FIFO. Retorna (consumido, faltante)."""
+                 order_id: Optional[int]=None, note:str="Consumo FIFO", commit: bool=True) -> Tuple[float, float]:
+    """Consome por FIFO. Retorna (consumido, faltante). commit=False: o chamador faz o commit."""
+    # só as colunas usadas (_FIFO_LOTS_SELECT)
+    lots = session.execute(_FIFO_LOTS_SELECT, {"ing_id": ingredient_id}).all()
+    takes: List[Dict] = []
+    moves: List[Dict] = []
+    remaining = _plan_fifo(lots, ingredient_id, qty_needed, order_id, note, takes, moves)
+    _apply_fifo(session, takes, moves)
+    consumed = qty_needed - remaining
+    if commit:
+        session.commit()
+    return consumed, remaining
+
+def _plan_fifo(lots, ingredient_id: int, qty_needed: float, order_id: Optional[int], note: str,
+               takes: List[Dict], moves: List[Dict]) -> float:
+    """Distribui qty_needed pelos lotes (já em ordem FIFO), acumulando em takes/moves. Retorna o faltante."""
     remaining = max(qty_needed, 0.0)
-    lots = session.query(StockLot).filter(
-        StockLot.ingredient_id==ingredient_id,
-        StockLot.qty_remaining>0
-    ).order_by(
-        StockLot.best_before.is_(None),
-        StockLot.best_before.asc(),
-        StockLot.created_at.asc()
-    ).all()
-    for lot in lots:
+    for lot_id, lot_remaining, lot_unit, buy_price in lots:
         if remaining <= 1e-12:
             break
-        taken = _consume_from_lot(session, lot, remaining, order_id, note)
+        taken = min(remaining, lot_remaining)
+        if taken <= 0:
+            continue
+        takes.append({"lot_id": lot_id, "take": taken})
+        moves.append(dict(
+            lot_id=lot_id, ingredient_id=ingredient_id, move_type="OUT",
+            qty=taken, unit=lot_unit, cost=taken*buy_price, order_id=order_id, notes=note
+        ))
         remaining -= taken
-    consumed = qty_needed - max(remaining, 0.0)
-    session.commit()
-    return consumed, max(remaining, 0.0)
-
-def discard_from_lot(session: Session, lot_id: int, qty: float, reason: str="Descartado") -> float:
+    return max(remaining, 0.0)
+
+def _apply_fifo(session: Session, takes: List[Dict], moves: List[Dict]):
+    if not takes:
+        return
+    # executemany: um UPDATE preparado e um INSERT em lote, sem unit of work
+    lot_table = StockLot.__table__
+    session.connection().execute(
+        lot_table.update().where(lot_table.c.id == bindparam("lot_id"))
+        .values(qty_remaining=lot_table.c.qty_remaining - bindparam("take")),
+        takes,
+    )
+    session.execute(insert(StockMove), moves)
+    _expire_lots(session, {t["lot_id"] for t in takes})
+    mark_stock_changed(session)
+
+def _expire_lots(session: Session, lot_ids: Set[int]):
+    """Lotes já carregados na sessão ficariam com saldo antigo após UPDATE via Core."""
+    for obj in list(session.identity_map.values()):
+        if isinstance(obj, StockLot) and obj.id in lot_ids:
+            session.expire(obj)
+
+def discard_from_lot(session: Session, lot_id: int, qty: float, reason: str="Descartado",
+                     commit: bool=True) -> float:
     lot = session.get(StockLot, lot_id)
     if not lot or qty <= 0:
         return 0.0
@@ -571,91 +900,263 @@ def discard_from_lot(session: Session, lot_id: int, qty: float, reason: str="Des
     session.add(LossEvent(
         ingredient_id=lot.ingredient_id, lot_id=lot.id, qty=taken, reason=reason
     ))
-    session.commit()
+    if commit:
+        session.commit()
     return taken
 
 def discard_expired(session: Session, ref_date: Optional[dt.date]=None) -> List[Tuple[int, float]]:
-    """Descarta lotes vencidos. Retorna [(lot_id, descartado_qty), ...]."""
+    """Descarta lotes vencidos numa única transação. Retorna [(lot_id, descartado_qty), ...]."""
     today = ref_date or dt.date.today()
-    out: List[Tuple[int,float]] = []
-    lots = session.query(StockLot).filter(
-        StockLot.best_before.isnot(None),
-        StockLot.qty_remaining>0,
-        StockLot.best_before < today
+    # SELECT ... FOR UPDATE + um UPDATE: RETURNING devolveria o saldo já zerado, não o descartado
+    lots = session.execute(
+        select(StockLot.id, StockLot.ingredient_id, StockLot.qty_remaining, StockLot.unit,
+               StockLot.buy_price, StockLot.best_before).where(
+            StockLot.best_before.isnot(None),
+            StockLot.qty_remaining>0,
+            StockLot.best_before < today
+        ).with_for_update()
     ).all()
-    for lot in lots:
-        q = lot.qty_remaining
-        if q > 0:
-            taken = discard_from_lot(session, lot.id, q, reason=f"Vencido em {lot.best_before}")
-            out.append((lot.id, taken))
-    return out
+    if not lots:
+        return []
+    lot_ids = [lot_id for lot_id, *_ in lots]
+    session.execute(update(StockLot.__table__).where(StockLot.__table__.c.id.in_(lot_ids)).values(qty_remaining=0))
+    moves, losses = [], []
+    for lot_id, ing_id, qty, unit, buy_price, best_before in lots:
+        reason = f"Vencido em {best_before}"
+        moves.append(dict(lot_id=lot_id, ingredient_id=ing_id, move_type="LOSS",
+                          qty=qty, unit=unit, cost=qty*buy_price, notes=reason))
+        losses.append(dict(ingredient_id=ing_id, lot_id=lot_id, qty=qty, reason=reason))
+    session.execute(insert(StockMove), moves)
+    session.execute(insert(LossEvent), losses)
+    _expire_lots(session, set(lot_ids))
+    mark_stock_changed(session)
+    session.commit()
+    return [(lot_id, qty) for lot_id, _, qty, *_ in lots]
 
 # ---------------------------------------------------------------------
 # Explosão de receita / custos
 # ---------------------------------------------------------------------
+RecipeGraph = Tuple[Dict[int, List[Tuple[Optional[int], Optional[int], float]]], Dict[int, float]]
+
+def _load_recipe_graph(session: Session, root_ids) -> RecipeGraph:
+    """Carrega de uma vez o subgrafo de receitas alcançável a partir de root_ids:
+    ({recipe_id: [(ingredient_id, sub_recipe_id, qty)]}, {recipe_id: yield_qty}).
+    Duas consultas por nível de sub-receita, em vez de uma por receita/coleção."""
+    items_by_recipe: Dict[int, List[Tuple[Optional[int], Optional[int], float]]] = {}
+    yield_by_recipe: Dict[int, float] = {}
+    frontier = {rid for rid in root_ids if rid}
+    seen: Set[int] = set()
+    while frontier:
+        seen |= frontier
+        for rid, yield_qty in session.query(Recipe.id, Recipe.yield_qty).filter(Recipe.id.in_(frontier)):
+            yield_by_recipe[rid] = yield_qty
+        next_frontier: Set[int] = set()
+        rows = session.query(
+            RecipeItem.recipe_id, RecipeItem.ingredient_id, RecipeItem.sub_recipe_id, RecipeItem.qty
+        ).filter(RecipeItem.recipe_id.in_(frontier)).order_by(RecipeItem.id.asc())
+        for rid, ing_id, sub_id, qty in rows:
+            items_by_recipe.setdefault(rid, []).append((ing_id, sub_id, qty))
+            if not ing_id and sub_id and sub_id not in seen:
+                next_frontier.add(sub_id)
+        frontier = next_frontier
+    return items_by_recipe, yield_by_recipe
+
+def _explode_from_graph(graph: RecipeGraph, recipe_id: int, factor: float = 1.0,
+                        memo: Optional[Dict[int, Dict[int, float]]] = None) -> Dict[int, float]:
+    """Vetor de insumos por receita (fator 1.0) calculado em pós-ordem com pilha explícita e
+    memorizado em `memo`: sub-receitas repetidas (ou receitas de vários itens) são expandidas uma vez."""
+    items_by_recipe, yield_by_recipe = graph
+    memo = {} if memo is None else memo
+    on_path: Set[int] = set()
+    stack = [(recipe_id, False)]
+    while stack:
+        rid, expanded = stack.pop()
+        if rid in memo:
+            continue
+        if not expanded:
+            if rid in on_path:
+                raise ValueError(f"Sub-receitas em ciclo a partir da receita #{recipe_id}.")
+            on_path.add(rid)
+            stack.append((rid, True))
+            for ing_id, sub_id, _ in items_by_recipe.get(rid, ()):
+                if not ing_id and sub_id and sub_id not in memo:
+                    stack.append((sub_id, False))
+            continue
+        vec: Dict[int, float] = {}
+        yield_qty = yield_by_recipe.get(rid)
+        if yield_qty:
+            for ing_id, sub_id, qty in items_by_recipe.get(rid, ()):
+                scale = qty / yield_qty
+                if ing_id:
+                    vec[ing_id] = vec.get(ing_id, 0.0) + scale
+                elif sub_id:
+                    for k, v in memo[sub_id].items():
+                        vec[k] = vec.get(k, 0.0) + v * scale
+        memo[rid] = vec
+        on_path.discard(rid)
+    return {k: v * factor for k, v in memo[recipe_id].items()}
+
 def explode_recipe(session: Session, recipe_id: int, factor: float = 1.0) -> Dict[int, float]:
     """
     Calcula insumos base (ingredient_id -> quantidade) para produzir 'factor' * rendimento da receita.
-    Considera sub-receitas recursivamente.
+    Considera sub-receitas (grafo carregado antes, expansão iterativa em memória).
     """
-    req: Dict[int, float] = {}
-    recipe = session.get(Recipe, recipe_id)
-    if not recipe or recipe.yield_qty == 0:
-        return req
-    scale = factor / recipe.yield_qty
-    for it in recipe.items:
-        if it.ingredient_id:
-            req[it.ingredient_id] = req.get(it.ingredient_id, 0.0) + (it.qty * scale)
-        elif it.sub_recipe_id:
-            sub_req = explode_recipe(session, it.sub_recipe_id, factor=it.qty * scale)
-            for k, v in sub_req.items():
-                req[k] = req.get(k, 0.0) + v
-    return req
+    return _explode_from_graph(_load_recipe_graph(session, [recipe_id]), recipe_id, factor)
+
+def explode_recipes(session: Session, recipe_ids) -> Dict[int, Dict[int, float]]:
+    """Explode várias receitas (fator 1.0) carregando o grafo de todas numa passada só."""
+    ids = {rid for rid in recipe_ids if rid}
+    graph = _load_recipe_graph(session, ids)
+    memo: Dict[int, Dict[int, float]] = {}  # sub-receitas comuns expandidas uma vez
+    return {rid: _explode_from_graph(graph, rid, memo=memo) for rid in ids}
 
 def required_ingredients_for_order(session: Session, order: Order) -> Dict[int, float]:
     """Soma insumos por todos os itens do pedido."""
     totals: Dict[int,float] = {}
-    for oi in order.items:
-        if not oi.product or not oi.product.recipe_id:
-            continue
-        per_unit = explode_recipe(session, oi.product.recipe_id, factor=1.0)
-        for ing_id, qty in per_unit.items():
-            totals[ing_id] = totals.get(ing_id, 0.0) + qty * oi.qty
+    # (receita, qty) direto do banco: não depende de order.items/product estarem carregados
+    lines = session.query(Product.recipe_id, OrderItem.qty)\
+        .join(Product, Product.id == OrderItem.product_id)\
+        .filter(OrderItem.order_id == order.id, Product.recipe_id.isnot(None)).all()
+    per_recipe = explode_recipes(session, [rid for rid, _ in lines])
+    for recipe_id, oi_qty in lines:
+        for ing_id, qty in per_recipe[recipe_id].items():
+            totals[ing_id] = totals.get(ing_id, 0.0) + qty * oi_qty
+    return totals
+
+def required_ingredients_for_orders(session: Session, order_ids) -> Dict[int, float]:
+    """Insumos somados de vários pedidos: agrupa as quantidades por receita no banco
+    e explode cada receita uma única vez (sub-receitas impedem um JOIN simples)."""
+    ids = set(order_ids)
+    if not ids:
+        return {}
+    qty_by_recipe = session.query(Product.recipe_id, func.sum(OrderItem.qty))\
+        .join(Product, Product.id == OrderItem.product_id)\
+        .filter(OrderItem.order_id.in_(ids), Product.recipe_id.isnot(None))\
+        .group_by(Product.recipe_id).all()
+    totals: Dict[int, float] = {}
+    per_recipe = explode_recipes(session, [recipe_id for recipe_id, _ in qty_by_recipe])
+    for recipe_id, qty in qty_by_recipe:
+        for ing_id, q in per_recipe[recipe_id].items():
+            totals[ing_id] = totals.get(ing_id, 0.0) + q * (qty or 0.0)
     return totals
 
+def available_quantities(session: Session, ingredient_ids) -> Dict[int, float]:
+    """Saldo em estoque por ingrediente ({ingredient_id: soma de qty_remaining}) numa consulta."""
+    ids = set(ingredient_ids)
+    if not ids:
+        return {}
+    rows = session.execute(_AVAIL_SUM_SELECT, {"ids": list(ids)}).all()
+    return {ing_id: float(qty or 0.0) for ing_id, qty in rows}
+
 def ingredient_shortages(session: Session, order: Order) -> List[Tuple[Ingredient, float]]:
     """Retorna [(ingrediente, faltante_qty>0)]."""
     req = required_ingredients_for_order(session, order)
-    shortages: List[Tuple[Ingredient,float]] = []
-    for ing_id, need in req.items():
-        available = session.query(StockLot).with_entities(StockLot.qty_remaining)\
-            .filter(StockLot.ingredient_id==ing_id, StockLot.qty_remaining>0).all()
-        available_qty = sum(q[0] for q in available)
-        if need > available_qty + 1e-9:
-            shortages.append((session.get(Ingredient, ing_id), need - available_qty))
-    return shortages
+    available = available_quantities(session, req)
+    missing = {ing_id: need - available.get(ing_id, 0.0)
+               for ing_id, need in req.items() if need > available.get(ing_id, 0.0) + 1e-9}
+    if not missing:
+        return []
+    ings = {i.id: i for i in session.query(Ingredient).filter(Ingredient.id.in_(missing))}
+    return [(ings.get(ing_id), qty) for ing_id, qty in missing.items()]
 
 def consume_fifo_for_order(session: Session, order: Order) -> Dict[int, Tuple[float,float]]:
-    """Consome estoque para todos os ingredientes do pedido. Retorna {ingredient_id: (consumido, faltante)}"""
+    """Consome estoque para todos os ingredientes do pedido: uma leitura de lotes,
+    um UPDATE em lote, um INSERT em lote e um commit no fim.
+    Retorna {ingredient_id: (consumido, faltante)}"""
     res: Dict[int, Tuple[float,float]] = {}
     req = required_ingredients_for_order(session, order)
+    if not req:
+        return res
+    lots_by_ing: Dict[int, List] = {}
+    for ing_id, *lot in session.execute(_FIFO_LOTS_MULTI_SELECT, {"ids": list(req)}):
+        lots_by_ing.setdefault(ing_id, []).append(lot)
+    takes: List[Dict] = []
+    moves: List[Dict] = []
+    note = f"Consumo pedido #{order.id}"
     for ing_id, qty in req.items():
-        ing = session.get(Ingredient, ing_id)
-        consumed, missing = consume_fifo(session, ing_id, qty, ing.unit if ing else "g",
-                                         order_id=order.id, note=f"Consumo pedido #{order.id}")
-        res[ing_id] = (consumed, missing)
+        missing = _plan_fifo(lots_by_ing.get(ing_id, ()), ing_id, qty, order.id, note, takes, moves)
+        res[ing_id] = (qty - missing, missing)
+    _apply_fifo(session, takes, moves)
+    session.commit()
     return res
 
-def estimate_product_unit_cost(session: Session, product: Product) -> float:
-    """Custo unitário estimado baseado no custo médio dos ingredientes."""
+_order_total_trigger = False  # ligado por run_safe_migrations quando o trigger existe
+
+def order_total_trigger_active() -> bool:
+    """True se o banco mantém Order.total sozinho (trigger trg_order_total no Postgres)."""
+    return _order_total_trigger
+
+def recompute_order_total(session: Session, order_id: int):
+    """Recalcula Order.total no banco (UPDATE com subconsulta), sem carregar os itens.
+    Caminho explícito para quando não há trigger (SQLite, ou Postgres sem permissão)."""
+    item_sum = select(func.coalesce(func.sum(OrderItem.qty * OrderItem.unit_price), 0.0))\
+        .where(OrderItem.order_id == Order.id).scalar_subquery()
+    session.execute(
+        update(Order).where(Order.id == order_id).values(total=item_sum)
+        .execution_options(synchronize_session=False)
+    )
+    loaded = session.identity_map.get(session.identity_key(Order, order_id))  # já na sessão: descarta total antigo
+    if loaded is not None:
+        session.expire(loaded, ["total"])
+
+def estimate_product_unit_cost(session: Session, product: Product,
+                               cost_cache: Optional[Dict[int, float]] = None) -> float:
+    """Custo unitário estimado baseado no custo médio dos ingredientes.
+    cost_cache ({ingredient_id: custo}) pode ser compartilhado entre chamadas; só os faltantes vão ao banco.
+    Para muitos produtos de uma vez prefira estimate_unit_costs_bulk."""
     if not product or not product.recipe_id:
         return 0.0
     req = explode_recipe(session, product.recipe_id, factor=1.0)
-    total = 0.0
-    for ing_id, qty in req.items():
-        unit_cost = average_cost(session, ing_id)
-        total += qty * unit_cost
-    return total
+    unit_costs = cost_cache if cost_cache is not None else {}
+    missing = [ing_id for ing_id in req if ing_id not in unit_costs]
+    if missing:
+        unit_costs.update(average_costs(session, missing))
+    return sum(qty * unit_costs[ing_id] for ing_id, qty in req.items())
+
+def average_costs(session: Session, ingredient_ids) -> Dict[int, float]:
+    """Versão em lote de average_cost: {ingredient_id: custo médio} com 2 consultas."""
+    ids = set(ingredient_ids)
+    if not ids:
+        return {}
+    out: Dict[int, float] = {}
+    lot_rows = session.execute(_AVG_COST_SELECT, {"ids": list(ids)}).all()
+    for ing_id, tot_val, tot_qty in lot_rows:
+        if tot_qty and tot_qty > 0:
+            out[ing_id] = tot_val / tot_qty
+    # fallback: último preço cadastrado para quem não tem lote com saldo
+    missing = ids - set(out)
+    if missing:
+        latest = session.query(
+            IngredientPrice.ingredient_id.label("ingredient_id"),
+            func.max(IngredientPrice.created_at).label("max_created"),
+        ).filter(IngredientPrice.ingredient_id.in_(missing))\
+            .group_by(IngredientPrice.ingredient_id).subquery()
+        price_rows = session.query(IngredientPrice.ingredient_id, IngredientPrice.price).join(
+            latest, and_(
+                IngredientPrice.ingredient_id == latest.c.ingredient_id,
+                IngredientPrice.created_at == latest.c.max_created,
+            )
+        ).all()
+        for ing_id, price in price_rows:
+            out[ing_id] = price
+    for ing_id in missing - set(out):
+        out[ing_id] = 0.0
+    return out
+
+def estimate_unit_costs_bulk(session: Session, product_ids) -> Dict[int, float]:
+    """Custo unitário estimado de vários produtos: {product_id: custo}, com custos de ingredientes buscados uma vez."""
+    ids = set(product_ids)
+    if not ids:
+        return {}
+    products = session.query(Product.id, Product.recipe_id).filter(Product.id.in_(ids)).all()
+    per_recipe = explode_recipes(session, [recipe_id for _, recipe_id in products])
+    ing_ids = {ing_id for req in per_recipe.values() for ing_id in req}
+    unit_costs = average_costs(session, ing_ids)
+    out: Dict[int, float] = {pid: 0.0 for pid in ids}
+    for pid, recipe_id in products:
+        if recipe_id:
+            out[pid] = sum(qty * unit_costs.get(ing_id, 0.0) for ing_id, qty in per_recipe[recipe_id].items())
+    return out
 
 # ---------------------------------------------------------------------
 # Inicialização do DB
@@ -671,4 +1172,5 @@ def init_db(engine):
         seed_default_roles(session)
         get_or_create_default_config(session)
         session.commit()
+        cleanup_expired_tokens(session)
     return engine
@@ -1,59 +1,98 @@
 # seed_basic.py
 # Semente simples para demonstração (idempotente).
+from sqlalchemy import insert, select
+
 from db import (
     init_db, make_engine, make_sessionmaker,
-    Ingredient, Recipe, RecipeItem, Product, Client, Order, OrderItem,
-    create_lot, estimate_product_unit_cost, get_or_create_default_config
+    Ingredient, Recipe, RecipeItem, Product, Client, Order, OrderItem, SeedMarker,
+    bulk_create_lots, estimate_product_unit_cost, get_or_create_default_config
 )
 
+# Dados da demonstração (só dados; run() monta os payloads a partir daqui)
+INGREDIENTS = [("Farinha de Trigo", "g"), ("Açúcar", "g"), ("Chocolate", "g")]
+# (ingrediente, quantidade, unidade, preço unitário)
+LOTS = [
+    ("Farinha de Trigo", 10000, "g", 0.010),  # R$0,01/g
+    ("Açúcar", 8000, "g", 0.008),
+    ("Chocolate", 5000, "g", 0.030),
+]
+RECIPE = dict(name="Bolo Base", yield_qty=1.0, unit="un", is_active=True)
+# (ingrediente, quantidade, tipo) da receita acima
+RECIPE_ITEMS = [
+    ("Farinha de Trigo", 300, "peso"),
+    ("Açúcar", 150, "peso"),
+    ("Chocolate", 100, "peso"),
+]
+PRODUCT = dict(name="Bolo de Chocolate", is_active=True)
+CLIENT = dict(name="Cliente Exemplo", phone="(11) 99999-0000", address="Rua A, 123", is_active=True)
+ORDER_QTY = 2
+SEED_TAG = "basic"
+
 def run():
     engine = init_db(make_engine())
     SessionLocal = make_sessionmaker(engine)
     with SessionLocal() as s:
+        # já aplicada: uma consulta pela PK e sai (também evita lotes duplicados a cada execução)
+        if s.get(SeedMarker, SEED_TAG):
+            print("Seed já aplicada.")
+            return
         # Ingredientes
-        ing_names = [("Farinha de Trigo","g"), ("Açúcar","g"), ("Chocolate","g")]
-        idmap = {}
-        for name, unit in ing_names:
-            obj = s.query(Ingredient).filter(Ingredient.name==name).first()
-            if not obj:
-                obj = Ingredient(name=name, unit=unit, is_active=True)
-                s.add(obj); s.flush()
-            idmap[name] = obj.id
+        # Postgres/SQLite: INSERT ... ON CONFLICT DO NOTHING (seguro com seeds concorrentes);
+        # outros bancos caem no add_all dos faltantes logo abaixo
+        dialect = s.get_bind().dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            if dialect == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert as upsert_insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert as upsert_insert
+            s.execute(
+                upsert_insert(Ingredient.__table__)
+                .values([dict(name=name, unit=unit, is_active=True) for name, unit in INGREDIENTS])
+                .on_conflict_do_nothing(index_elements=["name"])
+            )
+        idmap = dict(s.query(Ingredient.name, Ingredient.id).filter(Ingredient.name.in_([n for n, _ in INGREDIENTS])))
+        missing = [Ingredient(name=name, unit=unit, is_active=True) for name, unit in INGREDIENTS if name not in idmap]
+        if missing:
+            s.add_all(missing); s.flush()
+            idmap.update({obj.name: obj.id for obj in missing})
         # Lotes
-        create_lot(s, idmap["Farinha de Trigo"], 10000, "g", 0.010)  # R$0,01/g
-        create_lot(s, idmap["Açúcar"], 8000, "g", 0.008)
-        create_lot(s, idmap["Chocolate"], 5000, "g", 0.030)
-        # Receita: Bolo Base
-        r = s.query(Recipe).filter(Recipe.name=="Bolo Base").first()
+        bulk_create_lots(s, [
+            dict(ingredient_id=idmap[name], qty=qty, unit=unit, unit_price=price) for name, qty, unit, price in LOTS
+        ], commit=False)
+        # Receita
+        r = s.scalar(select(Recipe).where(Recipe.name == RECIPE["name"]).limit(1))
         if not r:
-            r = Recipe(name="Bolo Base", yield_qty=1.0, unit="un", is_active=True)
+            r = Recipe(**RECIPE)
             s.add(r); s.flush()
-            s.add_all([
-                RecipeItem(recipe_id=r.id, ingredient_id=idmap["Farinha de Trigo"], qty=300, item_type="peso"),
-                RecipeItem(recipe_id=r.id, ingredient_id=idmap["Açúcar"], qty=150, item_type="peso"),
-                RecipeItem(recipe_id=r.id, ingredient_id=idmap["Chocolate"], qty=100, item_type="peso"),
+            # itens num único INSERT em lote (Core), sem unit of work
+            s.execute(insert(RecipeItem), [
+                dict(recipe_id=r.id, ingredient_id=idmap[name], qty=qty, item_type=item_type)
+                for name, qty, item_type in RECIPE_ITEMS
             ])
-        # Produto
-        p = s.query(Product).filter(Product.name=="Bolo de Chocolate").first()
+        # margem e custos de ingredientes buscados uma vez, reaproveitáveis se o seed ganhar mais produtos
+        cfg = get_or_create_default_config(s)
+        margin = cfg.margin_default or 0.60
+        cost_cache = {}
+        # Produto, cliente e pedido: ligados pelos relacionamentos, gravados num flush só no commit
+        p = s.scalar(select(Product).where(Product.name == PRODUCT["name"]).limit(1))
         if not p:
-            p = Product(name="Bolo de Chocolate", recipe_id=r.id, is_active=True)
-            s.add(p); s.flush()
+            p = Product(recipe_id=r.id, **PRODUCT)
+            s.add(p)
         # Cliente
-        c = s.query(Client).filter(Client.name=="Cliente Exemplo").first()
+        c = s.scalar(select(Client).where(Client.name == CLIENT["name"]).limit(1))
         if not c:
-            c = Client(name="Cliente Exemplo", phone="(11) 99999-0000", address="Rua A, 123", is_active=True)
-            s.add(c); s.flush()
-        # Pedido
-        o = s.query(Order).filter(Order.client_id==c.id).first()
-        if not o:
-            cfg = get_or_create_default_config(s)
-            cost = estimate_product_unit_cost(s, p)
-            price = cost * (1.0 + (cfg.margin_default or 0.60))
-            o = Order(client_id=c.id, status="NOVO", paid=False, delivery_date=None, obs="Pedido de demonstração")
-            s.add(o); s.flush()
-            s.add(OrderItem(order_id=o.id, product_id=p.id, qty=2, unit_price=price, unit_cost_snapshot=cost))
-            s.flush()
-            o.total = 2*price
+            c = Client(**CLIENT)
+            s.add(c)
+        # Pedido (cliente recém-criado ainda não tem pedidos)
+        order_id = s.scalar(select(Order.id).where(Order.client_id == c.id).limit(1)) if c.id else None
+        if order_id is None:
+            cost = estimate_product_unit_cost(s, p, cost_cache=cost_cache)
+            price = cost * (1.0 + margin)
+            o = Order(client=c, status="NOVO", paid=False, delivery_date=None, obs="Pedido de demonstração",
+                      total=ORDER_QTY*price,
+                      items=[OrderItem(product=p, qty=ORDER_QTY, unit_price=price, unit_cost_snapshot=cost)])
+            s.add(o)
+        s.add(SeedMarker(tag=SEED_TAG))
         s.commit()
     print("Seed concluída.")
 
@@ -0,0 +1,43 @@
+# Renderiza o Kanban de verdade (Streamlit AppTest) contra um SQLite semeado.
+import os
+import sys
+
+import bcrypt
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+pytest.importorskip("streamlit.testing.v1")
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def admin_id(tmp_path_factory):
+    db_path = tmp_path_factory.mktemp("kanban") / "bakery.db"
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+
+    import seed_basic
+    from db import init_db, make_engine, make_sessionmaker, User, Role
+
+    seed_basic.run()  # pedido de demonstração em NOVO
+    engine = init_db(make_engine())
+    with make_sessionmaker(engine)() as s:
+        admin = s.query(Role).filter(Role.name == "admin").one()
+        u = User(username="admin", name="Admin", email="admin@example.com", is_active=True, is_admin=True,
+                 password_hash=bcrypt.hashpw(b"senha", bcrypt.gensalt(4)).decode("utf-8"))
+        u.roles.append(admin)
+        s.add(u); s.commit()
+        return u.id
+
+
+def test_kanban_renders_cards_with_move_options(admin_id):
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=30)
+    at.session_state["user"] = {"id": admin_id, "username": "admin"}
+    at.run()
+    at.sidebar.selectbox[0].select("Pedidos – Kanban").run()
+
+    assert not at.exception
+    moves = [sb for sb in at.selectbox if sb.label == "Mover para:"]
+    assert moves, "card do pedido em NOVO deveria oferecer os próximos estágios"
+    assert list(moves[0].options) == ["-", "PRA_PRODUCAO", "EM_PRODUCAO"]